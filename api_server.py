@@ -2,6 +2,8 @@
 # Backend nowej generacji LMArena Bridge
 
 import asyncio
+import functools
+import hmac
 import json
 import logging
 import os
@@ -10,21 +12,20 @@ import subprocess
 import time
 import uuid
 import re
-import threading
 import random
 import mimetypes
-from datetime import datetime
+from collections import deque, namedtuple
 from contextlib import asynccontextmanager
 
+import httpx
+import orjson
 import uvicorn
-import requests
-from packaging.version import parse as parse_version
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Request, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse, JSONResponse, Response
+from fastapi.responses import StreamingResponse, JSONResponse
 
 # --- Importy modułów wewnętrznych ---
-from modules.file_uploader import upload_to_file_bed
+from modules.file_uploader import upload_to_file_bed, close_client as close_file_bed_client
 
 
 # --- Podstawowa konfiguracja ---
@@ -37,33 +38,98 @@ CONFIG = {}  # Przechowuje konfigurację załadowaną z config.jsonc
 # Uwaga: obecna architektura zakłada, że tylko jedna karta przeglądarki jest aktywna.
 # Aby obsłużyć wiele kart, trzeba by rozszerzyć to do zarządzania wieloma połączeniami.
 browser_ws: WebSocket | None = None
-# response_channels przechowuje kolejki odpowiedzi dla każdego żądania API.
-# Klucz to request_id, wartość to asyncio.Queue.
-response_channels: dict[str, asyncio.Queue] = {}
-last_activity_time = None  # Rejestruje czas ostatniej aktywności
-idle_monitor_thread = None  # Wątek monitorujący bezczynność
-main_event_loop = None  # Główna pętla zdarzeń
+
+class ResponseChannel:
+    """
+    Lekki kanał odpowiedzi dla jednego żądania: deque + asyncio.Event.
+    Ma jednego producenta (websocket_endpoint) i jednego konsumenta (_process_lmarena_stream),
+    więc nie potrzebuje księgowania getterów/putterów, które prowadzi asyncio.Queue.
+    """
+    __slots__ = ("_items", "_ready")
+
+    def __init__(self):
+        self._items = deque()
+        self._ready = asyncio.Event()
+
+    def put_nowait(self, item):
+        self._items.append(item)
+        self._ready.set()
+
+    async def get(self, timeout: float | None = None):
+        """Zwraca kolejny element; gdy kanał jest pusty, czeka najwyżej timeout sekund (asyncio.TimeoutError)."""
+        while not self._items:
+            self._ready.clear()
+            await asyncio.wait_for(self._ready.wait(), timeout=timeout)
+        return self._items.popleft()
+
+# response_channels przechowuje kanały odpowiedzi dla każdego żądania API.
+# Klucz to request_id, wartość to ResponseChannel.
+response_channels: dict[str, ResponseChannel] = {}
+last_activity_time = None  # Czas ostatniej aktywności (time.monotonic(), odporny na zmiany zegara)
+idle_monitor_task = None  # Zadanie asyncio monitorujące bezczynność
 # Nowe: śledzi, czy trwa odświeżanie związane z weryfikacją Cloudflare
 IS_REFRESHING_FOR_VERIFICATION = False
+# Ustawiane, gdy pobrano aktualizację i serwer kończy pracę — nowe żądania czatu są wtedy odrzucane (503)
+IS_SHUTTING_DOWN_FOR_UPDATE = False
+UPDATE_DRAIN_TIMEOUT = 120  # Ile sekund czekamy na zakończenie trwających żądań przed zamknięciem serwera do aktualizacji
+
+# --- Polecenia WebSocket dla skryptu Tampermonkey ---
+# Ładunki poleceń są stałe, więc serializujemy je raz przy imporcie.
+# Wysyłamy je jako ramki tekstowe: skrypt parsuje event.data przez JSON.parse,
+# a ramka binarna dotarłaby do niego jako Blob.
+_RECONNECT_FRAME = orjson.dumps({"command": "reconnect"}).decode()
+_REFRESH_FRAME = orjson.dumps({"command": "refresh"}).decode()
+_SEND_PAGE_SOURCE_FRAME = orjson.dumps({"command": "send_page_source"}).decode()
+_ACTIVATE_ID_CAPTURE_FRAME = orjson.dumps({"command": "activate_id_capture"}).decode()
 
 
 # --- Mapowanie modeli ---
-# MODEL_NAME_TO_ID_MAP przechowuje teraz bogatsze obiekty: { "model_name": {"id": "...", "type": "..."} }
-MODEL_NAME_TO_ID_MAP = {}
+# MODEL_NAME_TO_ID_MAP przechowuje teraz bogatsze obiekty: { "model_name": ModelInfo(id="...", type="...") }
+# Lekkie krotki zamiast słowników — mniej pamięci na wpis i bezpośredni dostęp do pól.
+ModelInfo = namedtuple("ModelInfo", "id type")
+MODEL_NAME_TO_ID_MAP: dict[str, ModelInfo] = {}
 MODEL_ENDPOINT_MAP = {}  # Nowe: przechowuje mapowania modeli do session/message ID
 DEFAULT_MODEL_ID = None  # Domyślne ID modelu: None
 
+# Cache sparsowanych plików: ścieżka -> (mtime, wynik parsowania).
+# Jeśli plik nie zmienił się od ostatniego wczytania, pomijamy odczyt z dysku i parsowanie.
+_file_cache: dict[str, tuple[tuple[int, int], object]] = {}
+
+def _read_file_cached(path: str, parser) -> tuple[object, bool]:
+    """
+    Wczytuje plik i parsuje go funkcją `parser`, korzystając z cache opartego o czas modyfikacji.
+    Kluczem jest (st_mtime_ns, st_size) z jednego wywołania os.stat — nanosekundy i rozmiar wyłapują
+    też zapisy, które na systemach plików o zgrubnej rozdzielczości czasu dostają ten sam mtime.
+    Zwraca krotkę (wynik, czy_z_cache).
+    Gdy stat, odczyt lub parsowanie się nie powiedzie, wpis jest usuwany z cache — wywołujący resetuje wtedy
+    swój stan, więc plik przywrócony później z tym samym (mtime, rozmiar) musi zostać wczytany ponownie.
+    """
+    try:
+        st = os.stat(path)
+        signature = (st.st_mtime_ns, st.st_size)
+        cached = _file_cache.get(path)
+        if cached and cached[0] == signature:
+            return cached[1], True
+        with open(path, 'r', encoding='utf-8') as f:
+            parsed = parser(f.read())
+    except Exception:
+        _file_cache.pop(path, None)
+        raise
+    _file_cache[path] = (signature, parsed)
+    return parsed, False
+
 def load_model_endpoint_map():
     """Wczytuje mapowanie modeli -> endpointów z model_endpoint_map.json."""
     global MODEL_ENDPOINT_MAP
     try:
-        with open('model_endpoint_map.json', 'r', encoding='utf-8') as f:
-            content = f.read()
-            # Pozwalamy na pusty plik
-            if not content.strip():
-                MODEL_ENDPOINT_MAP = {}
-            else:
-                MODEL_ENDPOINT_MAP = json.loads(content)
+        # Pozwalamy na pusty plik
+        endpoint_map, from_cache = _read_file_cached(
+            'model_endpoint_map.json',
+            lambda content: orjson.loads(content) if content.strip() else {}
+        )
+        if from_cache:
+            return
+        MODEL_ENDPOINT_MAP = endpoint_map
         logger.info(f"Pomyślnie wczytano {len(MODEL_ENDPOINT_MAP)} mapowań endpointów z 'model_endpoint_map.json'.")
     except FileNotFoundError:
         logger.warning("Plik 'model_endpoint_map.json' nie został znaleziony. Używana będzie pusta mapa.")
@@ -72,45 +138,25 @@ def load_model_endpoint_map():
         logger.error(f"Błąd podczas ładowania/parowania 'model_endpoint_map.json': {e}. Używana będzie pusta mapa.")
         MODEL_ENDPOINT_MAP = {}
 
+# Komentarze JSONC usuwamy jednym przebiegiem wyrażenia regularnego.
+# Alternatywa z łańcuchem w cudzysłowie chroni "//" i "/*" wewnątrz wartości (np. URL-e).
+_JSONC_RE = re.compile(r'//[^\n]*|/\*.*?\*/|"(?:\\.|[^"\\])*"', re.DOTALL)
+
 def _parse_jsonc(jsonc_string: str) -> dict:
     """
     Solidne parsowanie JSONC, usuwanie komentarzy.
     """
-    lines = jsonc_string.splitlines()
-    no_comments_lines = []
-    in_block_comment = False
-    for line in lines:
-        stripped_line = line.strip()
-        if in_block_comment:
-            if '*/' in stripped_line:
-                in_block_comment = False
-                line = stripped_line.split('*/', 1)[1]
-            else:
-                continue
-        
-        if '/*' in line and not in_block_comment:
-            before_comment, _, after_comment = line.partition('/*')
-            if '*/' in after_comment:
-                _, _, after_block = after_comment.partition('*/')
-                line = before_comment + after_block
-            else:
-                line = before_comment
-                in_block_comment = True
-
-        if line.strip().startswith('//'):
-            continue
-        
-        no_comments_lines.append(line)
-
-    return json.loads("\n".join(no_comments_lines))
+    cleaned = _JSONC_RE.sub(lambda m: m.group(0) if m.group(0).startswith('"') else '', jsonc_string)
+    return orjson.loads(cleaned)
 
 def load_config():
     """Wczytuje konfigurację z config.jsonc i obsługuje komentarze JSONC."""
     global CONFIG
     try:
-        with open('config.jsonc', 'r', encoding='utf-8') as f:
-            content = f.read()
-        CONFIG = _parse_jsonc(content)
+        config, from_cache = _read_file_cached('config.jsonc', _parse_jsonc)
+        if from_cache:
+            return  # Plik się nie zmienił — obecny CONFIG jest aktualny
+        CONFIG = config
         logger.info("Pomyślnie wczytano konfigurację z 'config.jsonc'.")
         # Logowanie kluczowych ustawień
         logger.info(f"  - Tryb Tavern: {'✅ Włączony' if CONFIG.get('tavern_mode_enabled') else '❌ Wyłączony'}")
@@ -123,8 +169,9 @@ def load_model_map():
     """Wczytuje mapowanie modeli z models.json, obsługuje format 'id:type'."""
     global MODEL_NAME_TO_ID_MAP
     try:
-        with open('models.json', 'r', encoding='utf-8') as f:
-            raw_map = json.load(f)
+        raw_map, from_cache = _read_file_cached('models.json', orjson.loads)
+        if from_cache:
+            return
             
         processed_map = {}
         for name, value in raw_map.items():
@@ -132,10 +179,10 @@ def load_model_map():
                 parts = value.split(':', 1)
                 model_id = parts[0] if parts[0].lower() != 'null' else None
                 model_type = parts[1]
-                processed_map[name] = {"id": model_id, "type": model_type}
+                processed_map[name] = ModelInfo(model_id, model_type)
             else:
                 # Obsługa formatu domyślnego / starszego
-                processed_map[name] = {"id": value, "type": "text"}
+                processed_map[name] = ModelInfo(value, "text")
 
         MODEL_NAME_TO_ID_MAP = processed_map
         logger.info(f"Pomyślnie wczytano i sparsowano {len(MODEL_NAME_TO_ID_MAP)} modeli z 'models.json'.")
@@ -176,77 +223,139 @@ def check_and_display_announcement():
 # --- Sprawdzanie aktualizacji ---
 GITHUB_REPO = "Lianues/LMArenaBridge"
 
-def download_and_extract_update(version):
-    """Pobiera i rozpakowuje najnowszą wersję do folderu tymczasowego."""
+def _extract_update_zip(archive_path: str, update_dir: str):
+    """Rozpakowuje archiwum aktualizacji — operacja blokująca, uruchamiana w osobnym wątku."""
+    import zipfile
+    with zipfile.ZipFile(archive_path) as z:
+        z.extractall(update_dir)
+
+async def download_and_extract_update(client: httpx.AsyncClient, version):
+    """
+    Pobiera i rozpakowuje najnowszą wersję do folderu tymczasowego.
+    Archiwum jest strumieniowane do pliku tymczasowego zamiast trzymania go w całości w pamięci.
+    """
+    import tempfile
+    import zipfile
     update_dir = "update_temp"
     if not os.path.exists(update_dir):
         os.makedirs(update_dir)
 
+    archive_path = None
     try:
         zip_url = f"https://github.com/{GITHUB_REPO}/archive/refs/heads/main.zip"
         logger.info(f"Pobieram nową wersję z {zip_url}...")
-        response = requests.get(zip_url, timeout=60)
-        response.raise_for_status()
-
-        # Potrzebne importy zipfile i io
-        import zipfile
-        import io
-        with zipfile.ZipFile(io.BytesIO(response.content)) as z:
-            z.extractall(update_dir)
+        async with client.stream("GET", zip_url) as response:
+            response.raise_for_status()
+            with tempfile.NamedTemporaryFile(suffix=".zip", delete=False) as tf:
+                archive_path = tf.name
+                async for chunk in response.aiter_bytes(1 << 20):
+                    # Zapis porcji (do 1 MiB) w wątku — serwer obsługuje już żądania, więc nie blokujemy pętli zdarzeń
+                    await asyncio.to_thread(tf.write, chunk)
+
+        await asyncio.to_thread(_extract_update_zip, archive_path, update_dir)
         
         logger.info(f"Nowa wersja została pobrana i rozpakowana do '{update_dir}'.")
         return True
-    except requests.RequestException as e:
+    except httpx.HTTPError as e:
         logger.error(f"Błąd pobierania aktualizacji: {e}")
     except zipfile.BadZipFile:
         logger.error("Pobrany plik nie jest poprawnym archiwum zip.")
     except Exception as e:
         logger.error(f"Nieznany błąd podczas rozpakowywania aktualizacji: {e}")
+    finally:
+        if archive_path:
+            try:
+                os.remove(archive_path)
+            except OSError as e:
+                logger.warning(f"Nie udało się usunąć pliku tymczasowego '{archive_path}': {e}")
     
     return False
 
-def check_for_updates():
-    """Sprawdza GitHub pod kątem nowej wersji."""
+async def _shutdown_for_update():
+    """
+    Przygotowuje zamknięcie serwera do aktualizacji: odrzuca nowe żądania, czeka (do UPDATE_DRAIN_TIMEOUT s)
+    na trwające strumienie, pozostałe kończy komunikatem błędu i prosi przeglądarkę o ponowne połączenie.
+    Sprawdzanie aktualizacji działa w tle, gdy serwer już obsługuje żądania, więc nie możemy ich po prostu uciąć.
+    """
+    global IS_SHUTTING_DOWN_FOR_UPDATE
+    IS_SHUTTING_DOWN_FOR_UPDATE = True
+
+    deadline = time.monotonic() + UPDATE_DRAIN_TIMEOUT
+    if response_channels:
+        logger.info(f"Czekam na zakończenie {len(response_channels)} trwających żądań (maks. {UPDATE_DRAIN_TIMEOUT}s)...")
+    while response_channels and time.monotonic() < deadline:
+        await asyncio.sleep(0.5)
+
+    if response_channels:
+        logger.warning(f"{len(response_channels)} żądań nie zakończyło się w czasie — kończę je komunikatem o aktualizacji.")
+        for channel in list(response_channels.values()):
+            channel.put_nowait({"error": "Serwer jest restartowany w celu instalacji aktualizacji. Ponów żądanie za chwilę."})
+        # Czas na przekazanie błędu klientom i zamknięcie kanałów
+        drain_deadline = time.monotonic() + 5
+        while response_channels and time.monotonic() < drain_deadline:
+            await asyncio.sleep(0.2)
+
+    # Powiadamiamy przeglądarkę, że to planowany restart — skrypt połączy się ponownie z nową wersją
+    if browser_ws and browser_ws.client_state.name == 'CONNECTED':
+        try:
+            await browser_ws.send_text(_RECONNECT_FRAME)
+            logger.info("Wysłano do przeglądarki polecenie 'reconnect'.")
+        except Exception as e:
+            logger.error(f"Błąd wysyłania polecenia 'reconnect': {e}")
+
+    # Krótka przerwa, aby ostatnie odpowiedzi i polecenie 'reconnect' zdążyły zostać wysłane
+    await asyncio.sleep(2)
+
+async def check_for_updates():
+    """
+    Sprawdza GitHub pod kątem nowej wersji.
+    Uruchamiane jako zadanie w tle, więc nie opóźnia startu serwera.
+    """
     if not CONFIG.get("enable_auto_update", True):
         logger.info("Automatyczne aktualizacje są wyłączone — pomijam sprawdzenie.")
         return
 
+    # Importowane leniwie — potrzebne tylko przy sprawdzaniu aktualizacji
+    from packaging.version import parse as parse_version
+
     current_version = CONFIG.get("version", "0.0.0")
     logger.info(f"Aktualna wersja: {current_version}. Sprawdzam aktualizacje na GitHub...")
 
     try:
-        config_url = f"https://raw.githubusercontent.com/{GITHUB_REPO}/main/config.jsonc"
-        response = requests.get(config_url, timeout=10)
-        response.raise_for_status()
-
-        jsonc_content = response.text
-        remote_config = _parse_jsonc(jsonc_content)
-        
-        remote_version_str = remote_config.get("version")
-        if not remote_version_str:
-            logger.warning("W zdalnym pliku konfiguracyjnym nie znaleziono numeru wersji — pomijam sprawdzenie.")
-            return
+        # GitHub przekierowuje pobieranie archiwum na codeload, stąd follow_redirects
+        async with httpx.AsyncClient(timeout=httpx.Timeout(10.0, read=60.0), follow_redirects=True) as client:
+            config_url = f"https://raw.githubusercontent.com/{GITHUB_REPO}/main/config.jsonc"
+            response = await client.get(config_url)
+            response.raise_for_status()
+
+            jsonc_content = response.text
+            remote_config = _parse_jsonc(jsonc_content)
+            
+            remote_version_str = remote_config.get("version")
+            if not remote_version_str:
+                logger.warning("W zdalnym pliku konfiguracyjnym nie znaleziono numeru wersji — pomijam sprawdzenie.")
+                return
 
-        if parse_version(remote_version_str) > parse_version(current_version):
-            logger.info("="*60)
-            logger.info(f"🎉 Znaleziono nową wersję! 🎉")
-            logger.info(f"  - Obecna: {current_version}")
-            logger.info(f"  - Najnowsza: {remote_version_str}")
-            if download_and_extract_update(remote_version_str):
-                logger.info("Przygotowuję aplikację do aktualizacji. Serwer wyłączy się i uruchomi skrypt aktualizujący za 5 sekund.")
-                time.sleep(5)
-                update_script_path = os.path.join("modules", "update_script.py")
-                # Uruchamiamy niezależny proces Popen
-                subprocess.Popen([sys.executable, update_script_path])
-                # Eleganckie zakończenie bieżącego procesu
-                os._exit(0)
+            if parse_version(remote_version_str) > parse_version(current_version):
+                logger.info("="*60)
+                logger.info(f"🎉 Znaleziono nową wersję! 🎉")
+                logger.info(f"  - Obecna: {current_version}")
+                logger.info(f"  - Najnowsza: {remote_version_str}")
+                if await download_and_extract_update(client, remote_version_str):
+                    logger.info("Przygotowuję aplikację do aktualizacji. Serwer przestaje przyjmować nowe żądania, dokończy trwające i uruchomi skrypt aktualizujący.")
+                    await _shutdown_for_update()
+                    update_script_path = os.path.join("modules", "update_script.py")
+                    # Uruchamiamy niezależny proces Popen
+                    subprocess.Popen([sys.executable, update_script_path])
+                    # Eleganckie zakończenie bieżącego procesu
+                    os._exit(0)
+                else:
+                    logger.error(f"Automatyczna aktualizacja nie powiodła się. Pobierz ręcznie: https://github.com/{GITHUB_REPO}/releases/latest")
+                logger.info("="*60)
             else:
-                logger.error(f"Automatyczna aktualizacja nie powiodła się. Pobierz ręcznie: https://github.com/{GITHUB_REPO}/releases/latest")
-            logger.info("="*60)
-        else:
-            logger.info("Program jest aktualny.")
+                logger.info("Program jest aktualny.")
 
-    except requests.RequestException as e:
+    except httpx.HTTPError as e:
         logger.error(f"Błąd podczas sprawdzania aktualizacji: {e}")
     except json.JSONDecodeError:
         logger.error("Błąd parsowania zdalnego pliku konfiguracyjnego.")
@@ -254,52 +363,45 @@ def check_for_updates():
         logger.error(f"Nieznany błąd podczas sprawdzania aktualizacji: {e}")
 
 # --- Aktualizacja listy modeli ---
+_JSON_DECODER = json.JSONDecoder()
+
+# Początek obiektu modelu w treści po usunięciu escape'ów
+_MODEL_START_RE = re.compile(r'\{"id":"[a-f0-9-]+"')
+
 def extract_models_from_html(html_content):
     """
-    Wyodrębnia pełne obiekty JSON modeli z zawartości HTML, używając dopasowania nawiasów
-    aby zapewnić kompletność obiektu.
+    Wyodrębnia pełne obiekty JSON modeli z zawartości HTML.
+    Po jednorazowym usunięciu escape'ów każdy kandydat jest parsowany przez raw_decode,
+    który sam wyznacza koniec obiektu — nie trzeba ręcznie liczyć nawiasów.
     """
     models = []
     model_names = set()
-    
-    # Szukamy potencjalnych pozycji początku obiektu JSON modelu
-    for start_match in re.finditer(r'\{\\"id\\":\\"[a-f0-9-]+\\"', html_content):
-        start_index = start_match.start()
-        
-        # Dopasowywanie nawiasów od pozycji startowej
-        open_braces = 0
-        end_index = -1
-        
-        # Optymalizacja: ustaw limit wyszukiwania, by uniknąć nieskończonych pętli
-        search_limit = start_index + 10000  # zakładamy, że definicja modelu nie przekroczy 10000 znaków
-        
-        for i in range(start_index, min(len(html_content), search_limit)):
-            if html_content[i] == '{':
-                open_braces += 1
-            elif html_content[i] == '}':
-                open_braces -= 1
-                if open_braces == 0:
-                    end_index = i + 1
-                    break
-        
-        if end_index != -1:
-            # Wyciągamy kompletny, escape'owany JSON
-            json_string_escaped = html_content[start_index:end_index]
-            
-            # Usuwamy escape'y
-            json_string = json_string_escaped.replace('\\"', '"').replace('\\\\', '\\')
-            
-            try:
-                model_data = json.loads(json_string)
-                model_name = model_data.get('publicName')
-                
-                # Unikalność według publicName
-                if model_name and model_name not in model_names:
-                    models.append(model_data)
-                    model_names.add(model_name)
-            except json.JSONDecodeError as e:
-                logger.warning(f"Błąd parsowania wyodrębnionego obiektu JSON: {e} - fragment: {json_string[:150]}...")
-                continue
+
+    # Usuwamy escape'y raz dla całego dokumentu
+    content = html_content.replace('\\"', '"').replace('\\\\', '\\')
+
+    # Szukamy potencjalnych pozycji początku obiektu JSON modelu (id modelu to UUID — tylko znaki hex i myślniki)
+    match = _MODEL_START_RE.search(content)
+    while match:
+        idx = match.start()
+        try:
+            model_data, end_index = _JSON_DECODER.raw_decode(content, idx)
+        except json.JSONDecodeError as e:
+            logger.warning(f"Błąd parsowania wyodrębnionego obiektu JSON: {e} - fragment: {content[idx:idx + 150]}...")
+            match = _MODEL_START_RE.search(content, idx + 1)
+            continue
+
+        model_name = model_data.get('publicName')
+        if model_name:
+            # Unikalność według publicName
+            if model_name not in model_names:
+                models.append(model_data)
+                model_names.add(model_name)
+            # Przeskakujemy za obiekt modelu
+            match = _MODEL_START_RE.search(content, end_index)
+        else:
+            # To nie model (np. obiekt nadrzędny z własnym id) — modele mogą być w jego wnętrzu, więc szukamy dalej od środka
+            match = _MODEL_START_RE.search(content, idx + 1)
 
     if models:
         logger.info(f"Pomyślnie wyodrębniono i sparsowano {len(models)} modeli.")
@@ -315,76 +417,68 @@ def save_available_models(new_models_list, models_path="available_models.json"):
     logger.info(f"Wykryto {len(new_models_list)} modeli, aktualizuję '{models_path}'...")
     
     try:
-        with open(models_path, 'w', encoding='utf-8') as f:
-            # Zapisujemy bezpośrednio listę obiektów modeli
-            json.dump(new_models_list, f, indent=4, ensure_ascii=False)
+        # Zapisujemy bezpośrednio listę obiektów modeli — orjson buduje cały bufor od razu
+        try:
+            data = orjson.dumps(new_models_list, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+        except orjson.JSONEncodeError:
+            # orjson odrzuca niepoprawny UTF-8 (np. samotne surogaty) — wtedy używamy json z escape'owaniem
+            data = json.dumps(new_models_list, indent=2).encode('utf-8')
+        with open(models_path, 'wb') as f:
+            f.write(data)
         logger.info(f"✅ Plik '{models_path}' został zaktualizowany i zawiera {len(new_models_list)} modeli.")
     except IOError as e:
         logger.error(f"Błąd podczas zapisu pliku '{models_path}': {e}")
 
 # --- Logika automatycznego restartu ---
-def restart_server():
+async def restart_server():
     """Powiadamia klienta o odświeżeniu, a następnie restartuje serwer."""
     logger.warning("="*60)
     logger.warning("Wykryto długi czas bezczynności serwera — przygotowuję restart...")
     logger.warning("="*60)
     
-    # 1. (asynchronicznie) powiadom przeglądarkę o odświeżeniu
-    async def notify_browser_refresh():
-        if browser_ws:
-            try:
-                # Wysyłamy polecenie 'reconnect' aby poinformować frontend, że to planowany restart
-                await browser_ws.send_text(json.dumps({"command": "reconnect"}, ensure_ascii=False))
-                logger.info("Wysłano do przeglądarki polecenie 'reconnect'.")
-            except Exception as e:
-                logger.error(f"Błąd wysyłania polecenia 'reconnect': {e}")
-    
-    # Uruchamiamy asynchroniczną funkcję w głównej pętli zdarzeń
-    if browser_ws and browser_ws.client_state.name == 'CONNECTED' and main_event_loop:
-        asyncio.run_coroutine_threadsafe(notify_browser_refresh(), main_event_loop)
+    # 1. Powiadamiamy przeglądarkę o odświeżeniu
+    if browser_ws and browser_ws.client_state.name == 'CONNECTED':
+        try:
+            # Wysyłamy polecenie 'reconnect' aby poinformować frontend, że to planowany restart
+            await browser_ws.send_text(_RECONNECT_FRAME)
+            logger.info("Wysłano do przeglądarki polecenie 'reconnect'.")
+        except Exception as e:
+            logger.error(f"Błąd wysyłania polecenia 'reconnect': {e}")
     
     # 2. Krótkie opóźnienie, aby upewnić się, że wiadomość dotarła
-    time.sleep(3)
+    await asyncio.sleep(3)
     
     # 3. Wykonanie restartu
     logger.info("Restartuję serwer...")
     os.execv(sys.executable, ['python'] + sys.argv)
 
-def idle_monitor():
-    """Uruchamiane w tle — monitoruje bezczynność serwera."""
-    global last_activity_time
-    
-    # Czekamy, aż last_activity_time zostanie ustawione po starcie
-    while last_activity_time is None:
-        time.sleep(1)
-        
-    logger.info("Wątek monitorujący bezczynność uruchomiony.")
+async def idle_monitor():
+    """Zadanie w tle (w głównej pętli zdarzeń) — monitoruje bezczynność serwera."""
+    logger.info("Zadanie monitorujące bezczynność uruchomione.")
     
     while True:
+        # Sprawdzamy co 10 sekund
+        await asyncio.sleep(10)
+
         if CONFIG.get("enable_idle_restart", False):
             timeout = CONFIG.get("idle_restart_timeout_seconds", 300)
             
             # Jeśli timeout == -1, wyłączamy restart
             if timeout == -1:
-                time.sleep(10)  # pauza, aby uniknąć gorącej pętli
                 continue
 
-            idle_time = (datetime.now() - last_activity_time).total_seconds()
+            idle_time = time.monotonic() - last_activity_time
             
             if idle_time > timeout:
                 logger.info(f"Serwer był bezczynny przez {idle_time:.0f}s, przekroczono próg {timeout}s.")
-                restart_server()
+                await restart_server()
                 break  # kończymy, proces zostanie zastąpiony
-                
-        # Sprawdzamy co 10 sekund
-        time.sleep(10)
 
 # --- FastAPI lifecycle ---
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Funkcja wykonywana przy starcie serwera."""
-    global idle_monitor_thread, last_activity_time, main_event_loop
-    main_event_loop = asyncio.get_running_loop()  # Pobieramy główną pętlę zdarzeń
+    global idle_monitor_task, last_activity_time
     load_config()  # Najpierw wczytujemy konfigurację
     
     # --- Wypisanie aktualnego trybu działania ---
@@ -397,7 +491,11 @@ async def lifespan(app: FastAPI):
     logger.info("  (Tryb można zmienić uruchamiając id_updater.py)")
     logger.info("="*60)
 
-    check_for_updates()  # Sprawdź aktualizacje
+    # Koder tiktoken ładujemy w tle (asyncio.to_thread) — pierwsze żądanie nie czeka na pobranie pliku BPE
+    _ensure_tokenizer()
+
+    # Sprawdzanie aktualizacji działa w tle — serwer przyjmuje połączenia, zanim GitHub odpowie
+    update_check_task = asyncio.create_task(check_for_updates())
     load_model_map()  # Wczytaj mapę modeli
     load_model_endpoint_map()  # Wczytaj mapowanie endpointów modeli
     logger.info("Serwer uruchomiony. Oczekiwanie na połączenie skryptu Tampermonkey...")
@@ -406,18 +504,30 @@ async def lifespan(app: FastAPI):
     check_and_display_announcement()
 
     # Ustawiamy czas ostatniej aktywności po wczytaniu modeli
-    last_activity_time = datetime.now()
+    last_activity_time = time.monotonic()
     
-    # Uruchamiamy wątek monitorujący bezczynność, jeśli skonfigurowano
+    # Uruchamiamy zadanie monitorujące bezczynność, jeśli skonfigurowano
     if CONFIG.get("enable_idle_restart", False):
-        idle_monitor_thread = threading.Thread(target=idle_monitor, daemon=True)
-        idle_monitor_thread.start()
-        
+        idle_monitor_task = asyncio.create_task(idle_monitor())
 
     yield
+    if not update_check_task.done():
+        update_check_task.cancel()
+    if idle_monitor_task:
+        idle_monitor_task.cancel()
+    if _tokenizer_task and not _tokenizer_task.done():
+        _tokenizer_task.cancel()
+    await close_file_bed_client()
     logger.info("Serwer się zamyka.")
 
-app = FastAPI(lifespan=lifespan)
+class ORJSONResponse(JSONResponse):
+    """JSONResponse serializowany przez orjson — od razu zwraca bytes, bez json.dumps i osobnego kodowania UTF-8."""
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content)
+
+# ORJSONResponse jako domyślna klasa odpowiedzi obejmuje też endpointy zwracające zwykłe dict (np. /v1/models)
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
 # --- Konfiguracja middleware CORS ---
 # Dopuszczamy wszystkie źródła, metody i nagłówki — bezpieczne dla narzędzi lokalnych.
@@ -430,25 +540,29 @@ app.add_middleware(
 )
 
 # --- Funkcje pomocnicze ---
+# Wzorce dla save_config kompilujemy raz — klucze zapisywane do config.jsonc są stałe.
+# Regex znajdzie klucz i dopasuje jego wartość do przecinka lub zamknięcia obiektu.
+_CONFIG_VALUE_PATTERNS = {
+    key: re.compile(rf'("{key}"\s*:\s*").*?("?)(,?\s*)$', re.MULTILINE)
+    for key in ("session_id", "message_id")
+}
+_CONFIG_CLOSING_BRACE_RE = re.compile(r'}\s*$')
+
 def save_config():
     """Zapisuje obecny obiekt CONFIG z powrotem do config.jsonc, starając się zachować komentarze."""
     try:
         # Wczytujemy oryginalny plik, żeby zachować komentarze
         with open('config.jsonc', 'r', encoding='utf-8') as f:
-            lines = f.readlines()
+            content_str = f.read()
 
         # Bezpieczne zastępowanie wartości za pomocą wyrażeń regularnych
         def replacer(key, value, content):
-            # Regex znajdzie klucz i dopasuje jego wartość do przecinka lub zamknięcia obiektu
-            pattern = re.compile(rf'("{key}"\s*:\s*").*?("?)(,?\s*)$', re.MULTILINE)
             replacement = rf'\g<1>{value}\g<2>\g<3>'
-            if not pattern.search(content):  # Jeśli klucz nie istnieje, dodajemy go na końcu (prostsze podejście)
-                 content = re.sub(r'}\s*$', f'  ,"{key}": "{value}"\n}}', content)
-            else:
-                 content = pattern.sub(replacement, content)
+            content, count = _CONFIG_VALUE_PATTERNS[key].subn(replacement, content)
+            if count == 0:  # Jeśli klucz nie istnieje, dodajemy go na końcu (prostsze podejście)
+                content = _CONFIG_CLOSING_BRACE_RE.sub(f'  ,"{key}": "{value}"\n}}', content)
             return content
 
-        content_str = "".join(lines)
         content_str = replacer("session_id", CONFIG["session_id"], content_str)
         content_str = replacer("message_id", CONFIG["message_id"], content_str)
         
@@ -459,36 +573,61 @@ def save_config():
         logger.error(f"❌ Błąd zapisu do config.jsonc: {e}", exc_info=True)
 
 
-async def _process_openai_message(message: dict) -> dict:
+# Nagłówek data URI ("data:<typ MIME>;base64,...") — przechwytujemy typ MIME jednym dopasowaniem
+_DATA_URL_RE = re.compile(r'data:([^;,]*)')
+
+@functools.lru_cache(maxsize=256)
+def _guess_extension(content_type: str) -> str | None:
+    """mimetypes.guess_extension z pamięcią podręczną — zbiór spotykanych typów MIME jest niewielki."""
+    return mimetypes.guess_extension(content_type)
+
+def _process_openai_message(message: dict) -> dict:
     """
     Przetwarza wiadomość w formacie OpenAI, rozdzielając tekst i załączniki.
+    Nie modyfikuje wiadomości wejściowej — zwraca od razu gotowy szablon wiadomości LMArena.
+    - Zmienia niestandardową rolę 'developer' na 'system' dla zgodności.
     - Rozbija multimodalne części na czysty tekst i listę załączników.
     - Logika 'file bed' została przeniesiona do preprocesora chat_completions; tutaj tylko budujemy załączniki.
     - Zapewnia, że pusta treść roli 'user' zostanie zastąpiona spacją, aby uniknąć błędów po stronie LMArena.
     """
     content = message.get("content")
     role = message.get("role")
+    if role == "developer":
+        role = "system"
+        logger.info("Normalizacja roli wiadomości: zmieniono 'developer' na 'system'.")
+
+    # Najczęstszy przypadek: czysty tekst — pomijamy całą obsługę załączników
+    if isinstance(content, str):
+        if role == "user" and not content.strip():
+            content = " "
+        return {"role": role, "content": content, "attachments": []}
+
     attachments = []
     text_content = ""
 
     if isinstance(content, list):
+        # Lokalne referencje — unikamy wyszukiwania atrybutów modułu w każdej iteracji
+        guess_type = mimetypes.guess_type
+        guess_extension = _guess_extension
         text_parts = []
         for part in content:
-            if part.get("type") == "text":
+            part_type = part.get("type")
+            if part_type == "text":
                 text_parts.append(part.get("text", ""))
-            elif part.get("type") == "image_url":
+            elif part_type == "image_url":
                 # URL może być base64 lub HTTP (już zastąpiony przez preprocesor)
                 image_url_data = part.get("image_url", {})
                 url = image_url_data.get("url")
                 original_filename = image_url_data.get("detail")
 
                 try:
-                    # Dla base64 trzeba wyciągnąć content_type
-                    if url.startswith("data:"):
-                        content_type = url.split(';')[0].split(':')[1]
+                    # Dla base64 trzeba wyciągnąć content_type ("data:<typ>;base64,...")
+                    semi = url.find(';', 5)
+                    if url.startswith("data:") and semi != -1:
+                        content_type = url[5:semi]
                     else:
                         # Dla HTTP próbujemy zgadnąć typ MIME
-                        content_type = mimetypes.guess_type(url)[0] or 'application/octet-stream'
+                        content_type = guess_type(url)[0] or 'application/octet-stream'
 
                     # Na podstawie content_type wybieramy prefiks i rozszerzenie
                     if not original_filename:
@@ -497,7 +636,7 @@ async def _process_openai_message(message: dict) -> dict:
                         prefix = main_type if main_type in ['image', 'audio', 'video', 'application', 'text'] else 'file'
                         
                         # Używamy mimetypes do uzyskania rozszerzenia
-                        ext = mimetypes.guess_extension(content_type)
+                        ext = guess_extension(content_type)
                         if ext:
                             ext = ext.lstrip('.')
                         else:
@@ -518,8 +657,6 @@ async def _process_openai_message(message: dict) -> dict:
                     logger.warning(f"Błąd podczas przetwarzania URL załącznika: {url[:100]}... Błąd: {e}")
 
         text_content = "\n\n".join(text_parts)
-    elif isinstance(content, str):
-        text_content = content
 
     if role == "user" and not text_content.strip():
         text_content = " "
@@ -536,58 +673,59 @@ async def convert_openai_to_lmarena_payload(openai_data: dict, session_id: str,
     stosuje tryb Tavern, tryb Bypass oraz tryb battle.
     Dodatkowo obsługuje nadpisanie trybu (mode) dla danego modelu.
     """
-    # 1. Normalizacja ról i przetwarzanie wiadomości
-    #    - Zmieniamy niestandardową rolę 'developer' na 'system' dla zgodności.
-    #    - Rozdzielamy tekst i załączniki.
-    messages = openai_data.get("messages", [])
-    for msg in messages:
-        if msg.get("role") == "developer":
-            msg["role"] = "system"
-            logger.info("Normalizacja roli wiadomości: zmieniono 'developer' na 'system'.")
-            
-    processed_messages = []
-    for msg in messages:
-        processed_msg = await _process_openai_message(msg.copy())
-        processed_messages.append(processed_msg)
-
-    # 2. Zastosowanie trybu Tavern (Tavern Mode)
-    if CONFIG.get("tavern_mode_enabled"):
-        system_prompts = [msg['content'] for msg in processed_messages if msg['role'] == 'system']
-        other_messages = [msg for msg in processed_messages if msg['role'] != 'system']
-        
-        merged_system_prompt = "\n\n".join(system_prompts)
-        final_messages = []
-        
-        if merged_system_prompt:
-            # Wiadomości systemowe nie powinny zawierać załączników
-            final_messages.append({"role": "system", "content": merged_system_prompt, "attachments": []})
-        
-        final_messages.extend(other_messages)
-        processed_messages = final_messages
+    # 1. Ustalenie Participant Position
+    # Najpierw sprawdzamy nadpisanie trybu, inaczej używamy globalnej konfiguracji
+    mode = mode_override or CONFIG.get("id_updater_last_mode", "direct_chat")
+    target_participant = battle_target_override or CONFIG.get("id_updater_battle_target", "A")
+    target_participant = target_participant.lower()  # wymuszamy małe litery
+
+    logger.info(f"Ustawiam Participant Positions według trybu '{mode}' (cel: {target_participant if mode == 'battle' else 'N/A'}).")
+
+    if mode == 'battle':
+        # W trybie Battle: system i pozostałe wiadomości są po stronie wybranego asystenta (A -> 'a', B -> 'b')
+        system_position = other_position = target_participant
+    else:
+        # DirectChat: system zawsze 'b', pozostałe wiadomości domyślnie 'a'
+        system_position, other_position = 'b', 'a'
+
+    # 2. Przetwarzanie wiadomości w jednym przebiegu
+    #    - _process_openai_message normalizuje role i rozdziela tekst oraz załączniki.
+    #    - Od razu przypisujemy participantPosition.
+    #    - W trybie Tavern wiadomości systemowe odkładamy do scalenia.
+    tavern_mode = CONFIG.get("tavern_mode_enabled")
+    system_prompts = []
+    message_templates = []
+    for msg in openai_data.get("messages", []):
+        template = _process_openai_message(msg)
+        if template["role"] == "system":
+            if tavern_mode:
+                system_prompts.append(template["content"])
+                continue
+            template["participantPosition"] = system_position
+        else:
+            template["participantPosition"] = other_position
+        message_templates.append(template)
+
+    # Tryb Tavern: scalony prompt systemowy trafia jako pierwsza wiadomość
+    merged_system_prompt = "\n\n".join(system_prompts)
+    if merged_system_prompt:
+        # Wiadomości systemowe nie powinny zawierać załączników
+        message_templates.insert(0, {"role": "system", "content": merged_system_prompt, "attachments": [], "participantPosition": system_position})
 
     # 3. Określenie docelowego ID modelu
     model_name = openai_data.get("model", "claude-3-5-sonnet-20241022")
-    model_info = MODEL_NAME_TO_ID_MAP.get(model_name, {})  # Ważne: zawsze zapewniamy słownik
+    model_info = MODEL_NAME_TO_ID_MAP.get(model_name)  # None, jeśli model nie jest znany
     
     target_model_id = None
     if model_info:
-        target_model_id = model_info.get("id")
+        target_model_id = model_info.id
     else:
         logger.warning(f"Model '{model_name}' nie znaleziony w 'models.json'. Żądanie zostanie wysłane bez specyficznego ID modelu.")
 
     if not target_model_id:
         logger.warning(f"Model '{model_name}' nie ma przypisanego ID w 'models.json'. Żądanie zostanie wysłane bez ID modelu.")
 
-    # 4. Budowa szablonów wiadomości
-    message_templates = []
-    for msg in processed_messages:
-        message_templates.append({
-            "role": msg["role"],
-            "content": msg.get("content", ""),
-            "attachments": msg.get("attachments", [])
-        })
-    
-    # 4.5. Specjalne: jeśli wiadomość użytkownika kończy się na --bypass i zawiera obraz, budujemy fałszywą odpowiedź asystenta
+    # 4. Specjalne: jeśli wiadomość użytkownika kończy się na --bypass i zawiera obraz, budujemy fałszywą odpowiedź asystenta
     if message_templates and message_templates[-1]["role"] == "user":
         last_msg = message_templates[-1]
         if last_msg["content"].strip().endswith("--bypass") and last_msg.get("attachments"):
@@ -607,7 +745,8 @@ async def convert_openai_to_lmarena_payload(openai_data: dict, session_id: str,
                 fake_assistant_msg = {
                     "role": "assistant",
                     "content": "",  # pusta treść
-                    "attachments": last_msg.get("attachments", []).copy()  # kopiujemy obrazy
+                    "attachments": last_msg.get("attachments", []).copy(),  # kopiujemy obrazy
+                    "participantPosition": other_position
                 }
                 
                 # Czyścimy załączniki oryginalnej wiadomości użytkownika
@@ -622,39 +761,17 @@ async def convert_openai_to_lmarena_payload(openai_data: dict, session_id: str,
                     fake_user_msg = {
                         "role": "user",
                         "content": "Hi",
-                        "attachments": []
+                        "attachments": [],
+                        "participantPosition": other_position
                     }
                     message_templates.insert(0, fake_user_msg)
 
     # 5. Zastosowanie trybu Bypass (tylko dla modeli tekstowych)
-    model_type = model_info.get("type", "text")
+    model_type = model_info.type if model_info else "text"
     if CONFIG.get("bypass_enabled") and model_type == "text":
-        # Tryb bypass zawsze wstawia pustą wiadomość użytkownika z participantPosition 'a'
+        # Tryb bypass wstawia pustą wiadomość użytkownika na pozycji zwykłych wiadomości
         logger.info("Tryb Bypass jest włączony — wstrzykuję pustą wiadomość użytkownika.")
-        message_templates.append({"role": "user", "content": " ", "participantPosition": "a", "attachments": []})
-
-    # 6. Ustawienie Participant Position
-    # Najpierw sprawdzamy nadpisanie trybu, inaczej używamy globalnej konfiguracji
-    mode = mode_override or CONFIG.get("id_updater_last_mode", "direct_chat")
-    target_participant = battle_target_override or CONFIG.get("id_updater_battle_target", "A")
-    target_participant = target_participant.lower()  # wymuszamy małe litery
-
-    logger.info(f"Ustawiam Participant Positions według trybu '{mode}' (cel: {target_participant if mode == 'battle' else 'N/A'}).")
-
-    for msg in message_templates:
-        if msg['role'] == 'system':
-            if mode == 'battle':
-                # W trybie Battle: system i wybrany asystent są po tej samej stronie (A -> 'a', B -> 'b')
-                msg['participantPosition'] = target_participant
-            else:
-                # DirectChat: system zawsze 'b'
-                msg['participantPosition'] = 'b'
-        elif mode == 'battle':
-            # W trybie Battle, pozostałe wiadomości używają wybranego participant
-            msg['participantPosition'] = target_participant
-        else:  # DirectChat
-            # DirectChat: pozostałe wiadomości używają domyślnie 'a'
-            msg['participantPosition'] = 'a'
+        message_templates.append({"role": "user", "content": " ", "participantPosition": other_position, "attachments": []})
 
     return {
         "message_templates": message_templates,
@@ -664,31 +781,90 @@ async def convert_openai_to_lmarena_payload(openai_data: dict, session_id: str,
     }
 
 # --- Pomocnicze formatowanie zgodne z OpenAI (bezpieczne JSON) ---
-def format_openai_chunk(content: str, model: str, request_id: str) -> str:
+# Fragmenty SSE budujemy od razu jako bytes (orjson), więc StreamingResponse nie musi ich ponownie kodować.
+_SSE_DONE = b"\n\ndata: [DONE]\n\n"
+
+def format_openai_chunk(content: str, model: str, request_id: str, created: int | None = None) -> bytes:
     """Formatuje pojedynczy fragment strumieniowy zgodnie z formatem OpenAI SSE."""
     chunk = {
         "id": request_id, "object": "chat.completion.chunk",
-        "created": int(time.time()), "model": model,
+        "created": created if created is not None else int(time.time()), "model": model,
         "choices": [{"index": 0, "delta": {"content": content}, "finish_reason": None}]
     }
-    return f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+    return b"data: " + orjson.dumps(chunk) + b"\n\n"
+
+# Fragmenty treści różnią się tylko polem content, więc resztę koperty kodujemy raz na strumień
+_SSE_CONTENT_SUFFIX = b'},"finish_reason":null}]}\n\n'
 
-def format_openai_finish_chunk(model: str, request_id: str, reason: str = 'stop') -> str:
+def format_openai_chunk_prefix(model: str, request_id: str, created: int) -> bytes:
+    """Buduje stały początek fragmentu SSE (do pola content włącznie) — bajtowo zgodny z format_openai_chunk."""
+    return (
+        b'data: {"id":' + orjson.dumps(request_id)
+        + b',"object":"chat.completion.chunk","created":' + str(created).encode()
+        + b',"model":' + orjson.dumps(model)
+        + b',"choices":[{"index":0,"delta":{"content":'
+    )
+
+def format_openai_finish_chunk(model: str, request_id: str, reason: str = 'stop', created: int | None = None) -> bytes:
     """Formatuje końcowy fragment strumieniowy zgodny z OpenAI."""
     chunk = {
         "id": request_id, "object": "chat.completion.chunk",
-        "created": int(time.time()), "model": model,
+        "created": created if created is not None else int(time.time()), "model": model,
         "choices": [{"index": 0, "delta": {}, "finish_reason": reason}]
     }
-    return f"data: {json.dumps(chunk, ensure_ascii=False)}\n\ndata: [DONE]\n\n"
+    return b"data: " + orjson.dumps(chunk) + _SSE_DONE
 
-def format_openai_error_chunk(error_message: str, model: str, request_id: str) -> str:
+def format_openai_error_chunk(error_message: str, model: str, request_id: str, created: int | None = None) -> bytes:
     """Formatuje fragment błędu zgodny z OpenAI SSE."""
     content = f"\n\n[LMArena Bridge Error]: {error_message}"
-    return format_openai_chunk(content, model, request_id)
-
-def format_openai_non_stream_response(content: str, model: str, request_id: str, reason: str = 'stop') -> dict:
+    return format_openai_chunk(content, model, request_id, created)
+
+# --- Liczenie tokenów (opcjonalny tiktoken) ---
+# Koder ładujemy w tle przy starcie (pobranie pliku BPE i budowa kodera blokują), do tego czasu liczbę tokenów szacujemy.
+TOKENIZER = None
+TOKENIZER_RETRY_INTERVAL = 300  # Po nieudanym ładowaniu (np. błąd sieci) ponawiamy próbę najwcześniej po tylu sekundach
+TOKENIZE_INLINE_MAX_CHARS = 16384  # Dłuższe teksty kodujemy w wątku, żeby nie blokować pętli zdarzeń
+_tokenizer_task = None
+_tokenizer_retry_after = 0.0
+
+def _load_tokenizer():
+    """Importuje tiktoken i buduje koder cl100k_base (blokujące — wywoływane w wątku)."""
+    import tiktoken
+    return tiktoken.get_encoding("cl100k_base")
+
+async def _init_tokenizer():
+    """Ładuje koder w wątku. Brak pakietu tiktoken jest trwały, inne błędy (np. sieć) tylko odraczają kolejną próbę."""
+    global TOKENIZER, _tokenizer_retry_after
+    try:
+        TOKENIZER = await asyncio.to_thread(_load_tokenizer)
+        logger.info("Koder tiktoken (cl100k_base) został załadowany.")
+    except ImportError:
+        _tokenizer_retry_after = float("inf")
+        logger.info("tiktoken niedostępny — liczba tokenów będzie szacowana z długości tekstu.")
+    except Exception as e:
+        _tokenizer_retry_after = time.monotonic() + TOKENIZER_RETRY_INTERVAL
+        logger.warning(f"Nie udało się załadować kodera tiktoken ({e}) — ponowna próba za {TOKENIZER_RETRY_INTERVAL}s, do tego czasu liczba tokenów jest szacowana.")
+
+def _ensure_tokenizer():
+    """Uruchamia w tle (ponowne) ładowanie kodera, jeśli go brak, nic się nie ładuje i minął czas do kolejnej próby."""
+    global _tokenizer_task
+    if TOKENIZER is None and (_tokenizer_task is None or _tokenizer_task.done()) and time.monotonic() >= _tokenizer_retry_after:
+        _tokenizer_task = asyncio.create_task(_init_tokenizer())
+
+async def _count_tokens(text: str) -> int:
+    """Liczy tokeny tekstu koderem cl100k_base lub, gdy koder nie jest (jeszcze) dostępny, szacuje je jako len(text) // 4."""
+    _ensure_tokenizer()
+    tokenizer = TOKENIZER
+    if tokenizer is None:
+        return len(text) // 4
+    if len(text) <= TOKENIZE_INLINE_MAX_CHARS:
+        return len(tokenizer.encode_ordinary(text))
+    return len(await asyncio.to_thread(tokenizer.encode_ordinary, text))
+
+def format_openai_non_stream_response(content: str, model: str, request_id: str, reason: str = 'stop', completion_tokens: int | None = None) -> dict:
     """Buduje zgodne z OpenAI kompletne (nie-strumieniowe) ciało odpowiedzi."""
+    if completion_tokens is None:
+        completion_tokens = len(content) // 4
     return {
         "id": request_id,
         "object": "chat.completion",
@@ -701,17 +877,78 @@ def format_openai_non_stream_response(content: str, model: str, request_id: str,
         }],
         "usage": {
             "prompt_tokens": 0,
-            "completion_tokens": len(content) // 4,
-            "total_tokens": len(content) // 4,
+            "completion_tokens": completion_tokens,
+            "total_tokens": completion_tokens,
         },
     }
 
+# --- Wzorce parsera strumienia LMArena (kompilowane raz, przy imporcie modułu) ---
+# Tekst (a0/b0), obrazy (a2/b2) i powód zakończenia (ad/bd) w jednej alternatywie z nazwanymi grupami
+_STREAM_RE = re.compile(
+    r'[ab]0:"(?P<text>(?:\\.|[^"\\])*)"'
+    r'|[ab]2:(?P<image>\[.*?\])'
+    r'|[ab]d:(?P<finish>\{)'
+)
+_CF_RES = [re.compile(p, re.IGNORECASE) for p in (
+    r'<title>Just a moment...</title>',
+    r'Enable JavaScript and cookies to continue',
+)]
+# Tanie sprawdzenie literałów przed regexami — na zwykłej ścieżce strumienia regexy w ogóle się nie uruchamiają.
+# Literały są małymi literami i są warunkiem koniecznym dopasowania _CF_RES (bez wielkości liter, jak same regexy).
+_CF_LITERALS = ("just a moment", "enable javascript and cookies")
+
+def _is_cloudflare_challenge(text: str, start: int = 0, text_lower: str | None = None) -> bool:
+    """
+    Sprawdza, czy tekst (od pozycji start) wygląda na stronę weryfikacji Cloudflare. Wielkość liter nie ma znaczenia.
+    `text_lower` — gotowa kopia text[start:] małymi literami, jeśli wywołujący już ją ma.
+    """
+    if text_lower is None:
+        text_lower = text[start:].lower()
+    if not any(lit in text_lower for lit in _CF_LITERALS):
+        return False
+    return any(r.search(text, start) for r in _CF_RES)
+
+# --- Obsługa weryfikacji Cloudflare ---
+def _handle_cloudflare_verification(request_id: str) -> str:
+    """Wysyła (raz) polecenie odświeżenia przeglądarki i zwraca komunikat błędu dla klienta."""
+    global IS_REFRESHING_FOR_VERIFICATION
+    if not IS_REFRESHING_FOR_VERIFICATION:
+        logger.warning(f"PROCESSOR [ID: {request_id[:8]}]: Wykryto weryfikację CAPTCHA — wysyłam polecenie odświeżenia.")
+        IS_REFRESHING_FOR_VERIFICATION = True
+        if browser_ws:
+            asyncio.create_task(browser_ws.send_text(_REFRESH_FRAME))
+        return "Wykryto weryfikację CAPTCHA. Wysłano polecenie odświeżenia przeglądarki — spróbuj ponownie za kilka sekund."
+    else:
+        logger.info(f"PROCESSOR [ID: {request_id[:8]}]: Weryfikacja CAPTCHA już trwa — oczekuję na zakończenie.")
+        return "Trwa oczekiwanie na ukończenie weryfikacji CAPTCHA..."
+
+def _find_stream_error(buffer: str, start: int) -> dict | None:
+    """
+    Szuka w buforze (od pozycji start) kompletnego obiektu JSON postaci {"error": ...}.
+    Zamiast leniwego regexu używamy str.find + raw_decode, więc zagnieżdżone obiekty błędu też są poprawnie parsowane.
+    Niekompletny obiekt jest pomijany — zostanie znaleziony po nadejściu kolejnego fragmentu.
+    """
+    pos = start
+    while (i := buffer.find('"error"', pos)) != -1:
+        pos = i + 7
+        j = i - 1
+        while j >= start and buffer[j] in ' \t\r\n':
+            j -= 1
+        if j < start or buffer[j] != '{':
+            continue
+        try:
+            error_json, _ = _JSON_DECODER.raw_decode(buffer, j)
+        except json.JSONDecodeError:
+            continue
+        if isinstance(error_json, dict):
+            return error_json
+    return None
+
 async def _process_lmarena_stream(request_id: str):
     """
     Główny generator wewnętrzny: przetwarza surowy strumień z przeglądarki i emituje zdarzenia.
     Typy zdarzeń: ('content', str), ('finish', str), ('error', str)
     """
-    global IS_REFRESHING_FOR_VERIFICATION
     queue = response_channels.get(request_id)
     if not queue:
         logger.error(f"PROCESSOR [ID: {request_id[:8]}]: Nie znaleziono kanału odpowiedzi.")
@@ -719,49 +956,32 @@ async def _process_lmarena_stream(request_id: str):
         return
 
     buffer = ""
+    scan = 0  # Pozycja w buforze, od której zaczyna się jeszcze nieprzetworzona część
     timeout = CONFIG.get("stream_response_timeout_seconds",360)
-    text_pattern = re.compile(r'[ab]0:"((?:\\.|[^"\\])*)"')
-    # Nowe: wzorzec do dopasowania i wyciągnięcia URLi obrazów
-    image_pattern = re.compile(r'[ab]2:(\[.*?\])')
-    finish_pattern = re.compile(r'[ab]d:(\{.*?"finishReason".*?\})')
-    error_pattern = re.compile(r'(\{\s*"error".*?\})', re.DOTALL)
-    cloudflare_patterns = [r'<title>Just a moment...</title>', r'Enable JavaScript and cookies to continue']
-    
+
     has_yielded_content = False  # Flaga, czy wygenerowano już treść
 
     try:
         while True:
             try:
-                raw_data = await asyncio.wait_for(queue.get(), timeout=timeout)
+                raw_data = await queue.get(timeout)
             except asyncio.TimeoutError:
                 logger.warning(f"PROCESSOR [ID: {request_id[:8]}]: Oczekiwanie na dane z przeglądarki przekroczyło limit ({timeout}s).")
                 yield 'error', f'Przekroczono limit oczekiwania na odpowiedź po {timeout} sekundach.'
                 return
 
-            # --- Obsługa weryfikacji Cloudflare ---
-            def handle_cloudflare_verification():
-                global IS_REFRESHING_FOR_VERIFICATION
-                if not IS_REFRESHING_FOR_VERIFICATION:
-                    logger.warning(f"PROCESSOR [ID: {request_id[:8]}]: Wykryto weryfikację CAPTCHA — wysyłam polecenie odświeżenia.")
-                    IS_REFRESHING_FOR_VERIFICATION = True
-                    if browser_ws:
-                        asyncio.create_task(browser_ws.send_text(json.dumps({"command": "refresh"}, ensure_ascii=False)))
-                    return "Wykryto weryfikację CAPTCHA. Wysłano polecenie odświeżenia przeglądarki — spróbuj ponownie za kilka sekund."
-                else:
-                    logger.info(f"PROCESSOR [ID: {request_id[:8]}]: Weryfikacja CAPTCHA już trwa — oczekuję na zakończenie.")
-                    return "Trwa oczekiwanie na ukończenie weryfikacji CAPTCHA..."
-
             # 1. Sprawdzamy, czy otrzymaliśmy bezpośredni błąd z WebSocket
             if isinstance(raw_data, dict) and 'error' in raw_data:
                 error_msg = raw_data.get('error', 'Nieznany błąd przeglądarki')
                 if isinstance(error_msg, str):
-                    if '413' in error_msg or 'too large' in error_msg.lower():
+                    msg_lower = error_msg.lower()  # Jedna kopia małymi literami dla wszystkich sprawdzeń
+                    if '413' in error_msg or 'too large' in msg_lower:
                         friendly_error_msg = "Przesyłanie nie powiodło się: załącznik przekracza limit rozmiaru serwera LMArena (zwykle około 5MB). Spróbuj zmniejszyć plik lub przesłać mniejszy plik."
                         logger.warning(f"PROCESSOR [ID: {request_id[:8]}]: Wykryto błąd przekroczenia rozmiaru (413).")
                         yield 'error', friendly_error_msg
                         return
-                    if any(re.search(p, error_msg, re.IGNORECASE) for p in cloudflare_patterns):
-                        yield 'error', handle_cloudflare_verification()
+                    if _is_cloudflare_challenge(error_msg, text_lower=msg_lower):
+                        yield 'error', _handle_cloudflare_verification(request_id)
                         return
                 yield 'error', error_msg
                 return
@@ -774,122 +994,148 @@ async def _process_lmarena_stream(request_id: str):
                 break
 
             # 3. Doklejamy do bufora i analizujemy
-            buffer += "".join(str(item) for item in raw_data) if isinstance(raw_data, list) else raw_data
+            # Znaczniki Cloudflare sprawdzamy tylko w nowych danych (z zakładką na znacznik rozcięty między fragmentami)
+            cf_start = max(scan, len(buffer) - 64)
+            buffer += raw_data
 
-            if any(re.search(p, buffer, re.IGNORECASE) for p in cloudflare_patterns):
-                yield 'error', handle_cloudflare_verification()
+            if _is_cloudflare_challenge(buffer, cf_start):
+                yield 'error', _handle_cloudflare_verification(request_id)
                 return
             
-            if (error_match := error_pattern.search(buffer)):
-                try:
-                    error_json = json.loads(error_match.group(1))
-                    yield 'error', error_json.get("error", "Nieznany błąd z LMArena")
-                    return
-                except json.JSONDecodeError:
-                    pass
-
-            # Najpierw obsługujemy treść tekstową
-            while (match := text_pattern.search(buffer)):
-                try:
-                    text_content = json.loads(f'"{match.group(1)}"')
+            if (error_json := _find_stream_error(buffer, scan)) is not None:
+                yield 'error', error_json.get("error", "Nieznany błąd z LMArena")
+                return
+
+            # Tekst, obrazy i powód zakończenia wyłapujemy jednym przebiegiem, w kolejności występowania w strumieniu
+            while (match := _STREAM_RE.search(buffer, scan)):
+                kind = match.lastgroup
+                if kind == 'text':
+                    text_content = match.group("text")
+                    # Parser JSON jest potrzebny tylko, gdy token zawiera sekwencje ucieczki
+                    if '\\' in text_content:
+                        try:
+                            text_content = orjson.loads('"' + text_content + '"')
+                        except orjson.JSONDecodeError:
+                            text_content = ""
                     if text_content:
                         has_yielded_content = True
                         yield 'content', text_content
-                except (ValueError, json.JSONDecodeError):
-                    pass
-                buffer = buffer[match.end():]
-
-            # Nowe: obsługa zawartości obrazów
-            while (match := image_pattern.search(buffer)):
-                try:
-                    image_data_list = json.loads(match.group(1))
-                    if isinstance(image_data_list, list) and image_data_list:
-                        image_info = image_data_list[0]
-                        if image_info.get("type") == "image" and "image" in image_info:
-                            # Opakowujemy URL w Markdown i emitujemy jako blok treści
-                            markdown_image = f"![Image]({image_info['image']})"
-                            yield 'content', markdown_image
-                except (json.JSONDecodeError, IndexError) as e:
-                    logger.warning(f"Błąd parsowania URL obrazu: {e}, bufor: {buffer[:150]}")
-                buffer = buffer[match.end():]
-
-            if (finish_match := finish_pattern.search(buffer)):
-                try:
-                    finish_data = json.loads(finish_match.group(1))
-                    yield 'finish', finish_data.get("finishReason", "stop")
-                except (json.JSONDecodeError, IndexError):
-                    pass
-                buffer = buffer[finish_match.end():]
+                elif kind == 'image':
+                    try:
+                        image_data_list = orjson.loads(match.group("image"))
+                        if isinstance(image_data_list, list) and image_data_list:
+                            image_info = image_data_list[0]
+                            if image_info.get("type") == "image" and "image" in image_info:
+                                # Opakowujemy URL w Markdown i emitujemy jako blok treści
+                                markdown_image = f"![Image]({image_info['image']})"
+                                yield 'content', markdown_image
+                    except (json.JSONDecodeError, IndexError) as e:
+                        logger.warning(f"Błąd parsowania URL obrazu: {e}, bufor: {buffer[match.start():match.start() + 150]}")
+                else:
+                    # Obiekt zakończenia może zawierać zagnieżdżone pola (np. usage), więc dekodujemy dokładnie jeden obiekt JSON
+                    try:
+                        finish_data, end = _JSON_DECODER.raw_decode(buffer, match.start("finish"))
+                    except json.JSONDecodeError:
+                        if buffer.find('\n', match.end()) == -1:
+                            break  # Ramka jeszcze niekompletna — czekamy na kolejny fragment
+                        scan = match.end()  # Uszkodzona ramka — pomijamy ją
+                        continue
+                    if isinstance(finish_data, dict) and "finishReason" in finish_data:
+                        yield 'finish', finish_data["finishReason"]
+                    scan = end
+                    continue
+                scan = match.end()
+
+            # Bufor przycinamy dopiero, gdy przetworzony prefiks urośnie — unikamy kopiowania ogona przy każdym dopasowaniu
+            if scan > 65536:
+                buffer = buffer[scan:]
+                scan = 0
 
     except asyncio.CancelledError:
         logger.info(f"PROCESSOR [ID: {request_id[:8]}]: Zadanie anulowane.")
     finally:
-        if request_id in response_channels:
-            del response_channels[request_id]
+        if response_channels.pop(request_id, None) is not None:
             logger.info(f"PROCESSOR [ID: {request_id[:8]}]: Kanał odpowiedzi został posprzątany.")
 
 async def stream_generator(request_id: str, model: str):
     """Formatuje wewnętrzny strumień zdarzeń do odpowiedzi SSE w stylu OpenAI."""
     response_id = f"chatcmpl-{uuid.uuid4()}"
+    created = int(time.time())  # Jeden znacznik czasu dla wszystkich fragmentów strumienia, jak w API OpenAI
+    chunk_prefix = format_openai_chunk_prefix(model, response_id, created)
     logger.info(f"STREAMER [ID: {request_id[:8]}]: Uruchomiono generator strumieniowy.")
     
     finish_reason_to_send = 'stop'  # Domyślny powód zakończenia
 
     async for event_type, data in _process_lmarena_stream(request_id):
         if event_type == 'content':
-            yield format_openai_chunk(data, model, response_id)
+            yield chunk_prefix + orjson.dumps(data) + _SSE_CONTENT_SUFFIX
         elif event_type == 'finish':
             # Zapamiętujemy powód zakończenia, ale nie kończymy natychmiast — czekamy na [DONE]
             finish_reason_to_send = data
             if data == 'content-filter':
                 warning_msg = "\n\nOdpowiedź została przerwana — możliwe przekroczenie limitu kontekstu lub wewnętrzne filtrowanie modelu."
-                yield format_openai_chunk(warning_msg, model, response_id)
+                yield format_openai_chunk(warning_msg, model, response_id, created)
         elif event_type == 'error':
             logger.error(f"STREAMER [ID: {request_id[:8]}]: W strumieniu wystąpił błąd: {data}")
-            yield format_openai_error_chunk(str(data), model, response_id)
-            yield format_openai_finish_chunk(model, response_id, reason='stop')
+            yield format_openai_error_chunk(str(data), model, response_id, created)
+            yield format_openai_finish_chunk(model, response_id, reason='stop', created=created)
             return  # Przy błędzie kończymy
 
     # Wykonujemy to tylko gdy _process_lmarena_stream zakończy się naturalnie (otrzymano [DONE])
-    yield format_openai_finish_chunk(model, response_id, reason=finish_reason_to_send)
+    yield format_openai_finish_chunk(model, response_id, reason=finish_reason_to_send, created=created)
     logger.info(f"STREAMER [ID: {request_id[:8]}]: Generator strumieniowy zakończył się poprawnie.")
 
+# Mapowanie treści komunikatu błędu na (status HTTP, kod błędu) — pierwsza pasująca reguła wygrywa.
+# Domyślnie: 500 / "processing_error".
+_ERROR_RULES = (
+    ("przekracza limit rozmiaru", 413, "attachment_too_large"),
+    ("załącznik przekracza", 413, "attachment_too_large"),
+)
+
 async def non_stream_response(request_id: str, model: str):
     """Agreguje wewnętrzny strumień i zwraca jedną odpowiedź JSON zgodną z OpenAI."""
     response_id = f"chatcmpl-{uuid.uuid4()}"
     logger.info(f"NON-STREAM [ID: {request_id[:8]}]: Rozpoczynam przetwarzanie odpowiedzi nie-strumieniowej.")
     
+    # Lista + jeden "".join na końcu — w CPythonie szybsze niż io.StringIO przy tej samej szczytowej pamięci
     full_content = []
+    append_content = full_content.append
     finish_reason = "stop"
     
     async for event_type, data in _process_lmarena_stream(request_id):
         if event_type == 'content':
-            full_content.append(data)
+            append_content(data)
         elif event_type == 'finish':
             finish_reason = data
             if data == 'content-filter':
-                full_content.append("\n\nOdpowiedź została przerwana — możliwe przekroczenie limitu kontekstu lub wewnętrzne filtrowanie modelu.")
+                append_content("\n\nOdpowiedź została przerwana — możliwe przekroczenie limitu kontekstu lub wewnętrzne filtrowanie modelu.")
             # Nie przerywamy, czekamy na [DONE], by uniknąć warunków wyścigu
         elif event_type == 'error':
             logger.error(f"NON-STREAM [ID: {request_id[:8]}]: Wystąpił błąd podczas przetwarzania: {data}")
             
             # Ustalanie statusu błędu spójnie dla stream / non-stream
-            status_code = 413 if "przekracza limit rozmiaru" in str(data) or "załącznik przekracza" in str(data) else 500
+            error_text = str(data)
+            status_code, error_code = 500, "processing_error"
+            for needle, rule_status, rule_code in _ERROR_RULES:
+                if needle in error_text:
+                    status_code, error_code = rule_status, rule_code
+                    break
 
             error_response = {
                 "error": {
-                    "message": f"[LMArena Bridge Error]: {data}",
+                    "message": f"[LMArena Bridge Error]: {error_text}",
                     "type": "bridge_error",
-                    "code": "attachment_too_large" if status_code == 413 else "processing_error"
+                    "code": error_code
                 }
             }
-            return Response(content=json.dumps(error_response, ensure_ascii=False), status_code=status_code, media_type="application/json")
+            return ORJSONResponse(error_response, status_code=status_code)
 
     final_content = "".join(full_content)
-    response_data = format_openai_non_stream_response(final_content, model, response_id, reason=finish_reason)
+    completion_tokens = await _count_tokens(final_content)
+    response_data = format_openai_non_stream_response(final_content, model, response_id, reason=finish_reason, completion_tokens=completion_tokens)
     
     logger.info(f"NON-STREAM [ID: {request_id[:8]}]: Agregacja odpowiedzi zakończona.")
-    return Response(content=json.dumps(response_data, ensure_ascii=False), media_type="application/json")
+    return ORJSONResponse(response_data)
 
 # --- Punkt końcowy WebSocket ---
 @app.websocket("/ws")
@@ -911,7 +1157,7 @@ async def websocket_endpoint(websocket: WebSocket):
         while True:
             # Odbieramy wiadomości od skryptu Tampermonkey
             message_str = await websocket.receive_text()
-            message = json.loads(message_str)
+            message = orjson.loads(message_str)
             
             request_id = message.get("request_id")
             data = message.get("data")
@@ -920,9 +1166,14 @@ async def websocket_endpoint(websocket: WebSocket):
                 logger.warning(f"Otrzymano od przeglądarki nieprawidłową wiadomość: {message}")
                 continue
 
-            # Umieszczamy odebrane dane w odpowiedniej kolejce odpowiedzi
-            if request_id in response_channels:
-                await response_channels[request_id].put(data)
+            # Umieszczamy odebrane dane w odpowiednim kanale odpowiedzi.
+            # Kanały są nieograniczone, więc put_nowait nigdy nie blokuje i omija tworzenie korutyny.
+            channel = response_channels.get(request_id)
+            if channel is not None:
+                # Listy fragmentów sklejamy już tutaj, więc procesor strumienia zawsze dostaje str (lub dict z błędem)
+                if isinstance(data, list):
+                    data = "".join(map(str, data))
+                channel.put_nowait(data)
             else:
                 logger.warning(f"⚠️ Otrzymano odpowiedź dla nieznanego lub zamkniętego żądania: {request_id}")
 
@@ -934,7 +1185,7 @@ async def websocket_endpoint(websocket: WebSocket):
         browser_ws = None
         # Czyścimy wszystkie oczekujące kanały odpowiedzi, aby nie pozostawić wiszących żądań
         for queue in response_channels.values():
-            await queue.put({"error": "Browser disconnected during operation"})
+            queue.put_nowait({"error": "Browser disconnected during operation"})
         response_channels.clear()
         logger.info("Połączenie WebSocket zostało posprzątane.")
 
@@ -943,7 +1194,7 @@ async def websocket_endpoint(websocket: WebSocket):
 async def get_models():
     """Zwraca listę modeli zgodną z OpenAI."""
     if not MODEL_NAME_TO_ID_MAP:
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=404,
             content={"error": "Lista modeli jest pusta lub plik 'models.json' nie został znaleziony."}
         )
@@ -973,9 +1224,9 @@ async def request_model_update():
     
     try:
         logger.info("MODEL UPDATE: Otrzymano żądanie aktualizacji — wysyłam polecenie przez WebSocket...")
-        await browser_ws.send_text(json.dumps({"command": "send_page_source"}))
+        await browser_ws.send_text(_SEND_PAGE_SOURCE_FRAME)
         logger.info("MODEL UPDATE: Polecenie 'send_page_source' zostało wysłane.")
-        return JSONResponse({"status": "success", "message": "Polecenie wysłania źródła strony zostało wysłane."})
+        return ORJSONResponse({"status": "success", "message": "Polecenie wysłania źródła strony zostało wysłane."})
     except Exception as e:
         logger.error(f"MODEL UPDATE: Błąd podczas wysyłania polecenia: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail="Nie udało się wysłać polecenia przez WebSocket.")
@@ -988,7 +1239,7 @@ async def update_available_models_endpoint(request: Request):
     html_content = await request.body()
     if not html_content:
         logger.warning("Żądanie aktualizacji modeli nie zawierało treści HTML.")
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=400,
             content={"status": "error", "message": "Nie otrzymano treści HTML."}
         )
@@ -998,10 +1249,10 @@ async def update_available_models_endpoint(request: Request):
     
     if new_models_list:
         save_available_models(new_models_list)
-        return JSONResponse({"status": "success", "message": "Plik available_models.json został zaktualizowany."})
+        return ORJSONResponse({"status": "success", "message": "Plik available_models.json został zaktualizowany."})
     else:
         logger.error("Nie udało się wyodrębnić danych modeli z dostarczonego HTML.")
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=400,
             content={"status": "error", "message": "Nie można wyodrębnić danych modeli z HTML."}
         )
@@ -1015,8 +1266,8 @@ async def chat_completions(request: Request):
     a następnie zwraca wynik (stream lub non-stream).
     """
     global last_activity_time
-    last_activity_time = datetime.now()  # Aktualizujemy czas aktywności
-    logger.info(f"Otrzymano żądanie API — czas aktywności zaktualizowany: {last_activity_time.strftime('%Y-%m-%d %H:%M:%S')}")
+    last_activity_time = time.monotonic()  # Aktualizujemy czas aktywności
+    logger.info("Otrzymano żądanie API — czas aktywności zaktualizowany.")
 
     try:
         openai_req = await request.json()
@@ -1024,8 +1275,8 @@ async def chat_completions(request: Request):
         raise HTTPException(status_code=400, detail="Nieprawidłowe ciało żądania JSON")
 
     model_name = openai_req.get("model")
-    model_info = MODEL_NAME_TO_ID_MAP.get(model_name, {})  # Ważne: jeśli brak modelu, otrzymujemy pusty słownik
-    model_type = model_info.get("type", "text")  # Domyślnie text
+    model_info = MODEL_NAME_TO_ID_MAP.get(model_name)  # None, jeśli model nie jest znany
+    model_type = model_info.type if model_info else "text"  # Domyślnie text
 
     # --- Nowe: Logika rozpoznawania typu modelu ---
     if model_type == 'image':
@@ -1046,13 +1297,20 @@ async def chat_completions(request: Request):
                 detail="Brakujący klucz API. Podaj nagłówek Authorization w formacie 'Bearer YOUR_KEY'."
             )
         
-        provided_key = auth_header.split(' ')[1]
-        if provided_key != api_key:
+        provided_key = auth_header[7:]
+        # compare_digest porównuje w stałym czasie; na bajtach, bo dla str akceptuje tylko ASCII
+        if not hmac.compare_digest(provided_key.encode(), str(api_key).encode()):
             raise HTTPException(
                 status_code=401,
                 detail="Podany klucz API jest nieprawidłowy."
             )
 
+    if IS_SHUTTING_DOWN_FOR_UPDATE:
+        raise HTTPException(
+            status_code=503,
+            detail="Serwer instaluje aktualizację i za chwilę uruchomi się ponownie — spróbuj ponownie za kilkadziesiąt sekund."
+        )
+
     # --- Wzmacniana kontrola połączenia rozwiązująca warunki wyścigu po weryfikacji CAPTCHA ---
     if IS_REFRESHING_FOR_VERIFICATION and not browser_ws:
         raise HTTPException(
@@ -1121,7 +1379,7 @@ async def chat_completions(request: Request):
         logger.warning(f"Żądany model '{model_name}' nie występuje w models.json — zostanie użyty domyślny model.")
 
     request_id = str(uuid.uuid4())
-    response_channels[request_id] = asyncio.Queue()
+    response_channels[request_id] = ResponseChannel()
     logger.info(f"API CALL [ID: {request_id[:8]}]: Utworzono kanał odpowiedzi.")
 
     try:
@@ -1137,8 +1395,10 @@ async def chat_completions(request: Request):
                         base64_url = image_url_data.get("url")
                         original_filename = image_url_data.get("detail")
                         
-                        if not (base64_url and base64_url.startswith("data:")):
+                        data_url_match = _DATA_URL_RE.match(base64_url) if base64_url else None
+                        if not data_url_match:
                             raise ValueError(f"Nieprawidłowy format danych obrazka: {base64_url[:100] if base64_url else 'None'}")
+                        content_type = data_url_match.group(1)
 
                         upload_url = CONFIG.get("file_bed_upload_url")
                         if not upload_url:
@@ -1152,14 +1412,12 @@ async def chat_completions(request: Request):
                         # Jeśli brak nazwy pliku, generujemy ją na podstawie MIME z base64
                         if not original_filename:
                             try:
-                                content_type = base64_url.split(';')[0].split(':')[1]
-                                
                                 # Prefiks na podstawie typu MIME
                                 main_type = content_type.split('/')[0] if '/' in content_type else 'file'
                                 prefix = main_type if main_type in ['image', 'audio', 'video', 'application', 'text'] else 'file'
                                 
                                 # Próbujemy uzyskać rozszerzenie z mimetypes
-                                ext = mimetypes.guess_extension(content_type)
+                                ext = _guess_extension(content_type)
                                 if ext:
                                     ext = ext.lstrip('.')
                                 else:
@@ -1172,7 +1430,7 @@ async def chat_completions(request: Request):
                         else:
                             file_name = original_filename
                         
-                        logger.info(f"Preprocessing file bed: wysyłam '{file_name}' (MIME: {base64_url.split(';')[0].split(':')[1] if base64_url.startswith('data:') else 'unknown'})...")
+                        logger.info(f"Preprocessing file bed: wysyłam '{file_name}' (MIME: {content_type or 'unknown'})...")
                         
                         uploaded_filename, error_message = await upload_to_file_bed(file_name, base64_url, upload_url, api_key)
 
@@ -1207,7 +1465,7 @@ async def chat_completions(request: Request):
         
         # 3. Wysyłka przez WebSocket
         logger.info(f"API CALL [ID: {request_id[:8]}]: Wysyłam ładunek do skryptu Tampermonkey przez WebSocket.")
-        await browser_ws.send_text(json.dumps(message_to_browser))
+        await browser_ws.send_text(orjson.dumps(message_to_browser).decode())
 
         # 4. Zwracamy strumieniowo lub jako non-stream w zależności od parametru stream
         is_stream = openai_req.get("stream", False)
@@ -1224,20 +1482,18 @@ async def chat_completions(request: Request):
     except (ValueError, IOError) as e:
         # Błędy związane z przetwarzaniem załączników
         logger.error(f"API CALL [ID: {request_id[:8]}]: Błąd podczas preprocesu załączników: {e}")
-        if request_id in response_channels:
-            del response_channels[request_id]
+        response_channels.pop(request_id, None)
         # Zwracamy poprawnie sformatowany błąd JSON
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=500,
             content={"error": {"message": f"[LMArena Bridge Error] Błąd przetwarzania załączników: {e}", "type": "attachment_error"}}
         )
     except Exception as e:
         # Inne nieoczekiwane błędy
-        if request_id in response_channels:
-            del response_channels[request_id]
+        response_channels.pop(request_id, None)
         logger.error(f"API CALL [ID: {request_id[:8]}]: Krytyczny błąd podczas obsługi żądania: {e}", exc_info=True)
         # Zwracamy także poprawnie sformatowany błąd JSON
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=500,
             content={"error": {"message": str(e), "type": "internal_server_error"}}
         )
@@ -1255,9 +1511,9 @@ async def start_id_capture():
     
     try:
         logger.info("ID CAPTURE: Otrzymano prośbę o aktywację — wysyłam polecenie przez WebSocket...")
-        await browser_ws.send_text(json.dumps({"command": "activate_id_capture"}))
+        await browser_ws.send_text(_ACTIVATE_ID_CAPTURE_FRAME)
         logger.info("ID CAPTURE: Polecenie aktywacji zostało wysłane.")
-        return JSONResponse({"status": "success", "message": "Polecenie aktywacji zostało wysłane."})
+        return ORJSONResponse({"status": "success", "message": "Polecenie aktywacji zostało wysłane."})
     except Exception as e:
         logger.error(f"ID CAPTURE: Błąd podczas wysyłania polecenia aktywacji: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail="Nie udało się wysłać polecenia przez WebSocket.")
@@ -1270,5 +1526,23 @@ if __name__ == "__main__":
     logger.info(f"🚀 Serwer API LMArena Bridge v2.0 uruchamia się...")
     logger.info(f"   - Adres nasłuchu: http://127.0.0.1:{api_port}")
     logger.info(f"   - Punkt WebSocket: ws://127.0.0.1:{api_port}/ws")
-    
-    uvicorn.run(app, host="0.0.0.0", port=api_port)
\ No newline at end of file
+
+    # uvloop (pętla oparta o libuv) i httptools (parser HTTP w C) są szybsze od domyślnych
+    # implementacji asyncio/h11. uvloop nie jest dostępny na Windows — wtedy zostajemy przy asyncio.
+    try:
+        import uvloop  # noqa: F401
+        loop_impl = "uvloop"
+    except ImportError:
+        loop_impl = "asyncio"
+    try:
+        import httptools  # noqa: F401
+        http_impl = "httptools"
+    except ImportError:
+        http_impl = "h11"
+    logger.info(f"   - Pętla zdarzeń: {loop_impl}, parser HTTP: {http_impl}")
+
+    # Ramki WebSocket (polecenia i fragmenty odpowiedzi) są małe — kompresja permessage-deflate kosztuje więcej, niż oszczędza
+    uvicorn.run(
+        app, host="0.0.0.0", port=api_port, loop=loop_impl, http=http_impl,
+        ws_per_message_deflate=False, log_level="warning"
+    )
\ No newline at end of file
@@ -1,16 +1,28 @@
 # file_bed_server/main.py
-import base64
+import asyncio
+import mimetypes
 import os
-import uuid
+import re
+import secrets
+import shutil
 import time
+import orjson
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import asynccontextmanager
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.responses import JSONResponse
 from fastapi.staticfiles import StaticFiles
+from starlette.datastructures import UploadFile
 from pydantic import BaseModel
 import logging
-from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+
+# pybase64 (SIMD, libbase64) dekoduje duże pliki wielokrotnie szybciej niż stdlib; bez niego używamy modułu base64
+try:
+    import pybase64 as base64
+except ImportError:
+    import base64
 
 # --- Podstawowa konfiguracja ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -23,8 +35,18 @@ UPLOAD_DIR = os.path.join(BASE_DIR, "uploads")
 API_KEY = "your_secret_api_key"  # Prosty klucz uwierzytelniający
 CLEANUP_INTERVAL_MINUTES = 1  # Częstotliwość zadania czyszczącego (minuty)
 FILE_MAX_AGE_MINUTES = 10  # Maksymalny wiek pliku do przechowania (minuty)
+CLEANUP_WORKERS = 8  # Liczba wątków usuwających przeterminowane pliki równolegle
+CLEANUP_LOG_NAMES = 10  # Ile nazw usuniętych plików wypisać w podsumowaniu czyszczenia
 
 # --- Funkcja czyszcząca stare pliki ---
+def _remove_file(path: str) -> OSError | None:
+    """Usuwa plik; zwraca wyjątek zamiast go rzucać, aby jeden błąd nie przerywał całej partii."""
+    try:
+        os.remove(path)
+    except OSError as e:
+        return e
+    return None
+
 def cleanup_old_files():
     """Przechodzi przez katalog uploadów i usuwa pliki starsze niż zadany czas."""
     now = time.time()
@@ -32,36 +54,58 @@ def cleanup_old_files():
     
     logger.info(f"Uruchamiam zadanie czyszczenia — usuwam pliki starsze niż {datetime.fromtimestamp(cutoff).strftime('%Y-%m-%d %H:%M:%S')}...")
     
-    deleted_count = 0
+    # Usunięte pliki zbieramy i logujemy jednym wpisem na końcu zamiast osobnego logger.info dla każdego pliku
+    deleted_names: list[str] = []
     try:
-        for filename in os.listdir(UPLOAD_DIR):
-            file_path = os.path.join(UPLOAD_DIR, filename)
-            if os.path.isfile(file_path):
+        # 1. Zbieramy przeterminowane pliki. scandir zwraca typ wpisu razem z nazwą (getdents64 + d_type),
+        #    więc na plik wypada jedno stat zamiast trzech wywołań
+        expired = []
+        with os.scandir(UPLOAD_DIR) as entries:
+            for entry in entries:
                 try:
-                    file_mtime = os.path.getmtime(file_path)
-                    if file_mtime < cutoff:
-                        os.remove(file_path)
-                        logger.info(f"Usunięto przeterminowany plik: {filename}")
-                        deleted_count += 1
+                    if entry.is_file(follow_symlinks=False) and entry.stat(follow_symlinks=False).st_mtime < cutoff:
+                        expired.append((entry.name, entry.path))
                 except OSError as e:
-                    logger.error(f"Błąd podczas usuwania pliku '{file_path}': {e}")
+                    logger.error(f"Błąd podczas sprawdzania pliku '{entry.path}': {e}")
+
+        # 2. Usuwamy je partią w puli wątków — operacje na systemie plików nakładają się w jądrze
+        if expired:
+            with ThreadPoolExecutor(max_workers=min(CLEANUP_WORKERS, len(expired))) as executor:
+                results = executor.map(_remove_file, [path for _, path in expired])
+                for (name, path), error in zip(expired, results):
+                    if error is None:
+                        deleted_names.append(name)
+                    else:
+                        logger.error(f"Błąd podczas usuwania pliku '{path}': {error}")
     except Exception as e:
         logger.error(f"Nieoczekiwany błąd podczas czyszczenia starych plików: {e}", exc_info=True)
 
-    if deleted_count > 0:
-        logger.info(f"Zadanie czyszczenia zakończone — usunięto {deleted_count} plik(ów).")
+    if deleted_names:
+        more = f" (i {len(deleted_names) - CLEANUP_LOG_NAMES} więcej)" if len(deleted_names) > CLEANUP_LOG_NAMES else ""
+        logger.info(
+            f"Zadanie czyszczenia zakończone — usunięto {len(deleted_names)} plik(ów): "
+            f"{', '.join(deleted_names[:CLEANUP_LOG_NAMES])}{more}"
+        )
     else:
         logger.info("Zadanie czyszczenia zakończone — brak plików do usunięcia.")
 
 
+async def cleanup_old_files_async():
+    """Zadanie schedulera — skanowanie i usuwanie (blokujące wywołania systemowe) wykonujemy w wątku roboczym."""
+    await asyncio.to_thread(cleanup_old_files)
+
+
 # --- FastAPI lifecycle ---
-scheduler = BackgroundScheduler(timezone="UTC")
+# AsyncIOScheduler działa w pętli zdarzeń serwera (bez własnego wątku schedulera); samo czyszczenie idzie przez asyncio.to_thread
+scheduler = AsyncIOScheduler(timezone="UTC")
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Uruchamiane przy starcie serwera — startuje zadanie w tle; przy zamknięciu zatrzymuje je."""
+    # Budujemy mapę typów MIME od razu, zamiast leniwie przy pierwszym uploadzie bez rozszerzenia
+    mimetypes.init()
     # Uruchamiamy scheduler i dodajemy zadanie czyszczenia
-    scheduler.add_job(cleanup_old_files, 'interval', minutes=CLEANUP_INTERVAL_MINUTES)
+    scheduler.add_job(cleanup_old_files_async, 'interval', minutes=CLEANUP_INTERVAL_MINUTES)
     scheduler.start()
     logger.info(f"Zadanie czyszczenia plików uruchomione — będzie uruchamiane co {CLEANUP_INTERVAL_MINUTES} minut.")
     yield
@@ -70,7 +114,14 @@ async def lifespan(app: FastAPI):
     logger.info("Zadanie czyszczenia plików zostało zatrzymane.")
 
 
-app = FastAPI(lifespan=lifespan)
+class ORJSONResponse(JSONResponse):
+    """JSONResponse serializowany przez orjson — od razu zwraca bytes, bez json.dumps i osobnego kodowania UTF-8."""
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content)
+
+# Endpointy zwracają zwykłe dict, a domyślna klasa odpowiedzi serializuje je przez orjson
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
 # --- Upewnij się, że katalog upload istnieje ---
 if not os.path.exists(UPLOAD_DIR):
@@ -86,50 +137,141 @@ class UploadRequest(BaseModel):
     file_data: str  # odbiera kompletny Base64 data URI
     api_key: str | None = None
 
-# --- Endpointy API ---
-@app.post("/upload")
-async def upload_file(request: UploadRequest, http_request: Request):
+# --- Funkcje pomocnicze uploadu ---
+UPLOAD_CHUNK_SIZE = 1 << 20  # Rozmiar porcji przy kopiowaniu przesłanego pliku na dysk (1 MiB)
+BASE64_CHUNK_CHARS = 4 << 18  # Porcja base64 dekodowana naraz (1 MiB znaków → 768 KiB danych); wielokrotność 4
+# Znaki ASCII spoza alfabetu base64 (białe znaki itp.) — pomijane jak w b64decode bez walidacji.
+# Znaki spoza ASCII zostają, żeby dekoder odrzucił je błędem jak dawniej.
+_BASE64_JUNK_RE = re.compile(r'[^A-Za-z0-9+/=\u0080-\U0010ffff]+')
+# Najczęstsze typy MIME — sprawdzane przed mimetypes.guess_extension
+_EXT_CACHE = {
+    "image/png": ".png",
+    "image/jpeg": ".jpg",
+    "image/webp": ".webp",
+    "image/gif": ".gif",
+    "application/pdf": ".pdf",
+}
+
+def _build_unique_path(file_name: str, mime_type: str | None) -> tuple[str, str]:
+    """Zwraca (unikalna_nazwa, pełna_ścieżka) dla zapisywanego pliku; rozszerzenie bierze z nazwy lub typu MIME."""
+    file_extension = os.path.splitext(file_name)[1]
+    if not file_extension:
+        # Próba wywnioskowania rozszerzenia z typu MIME
+        guessed_extension = (_EXT_CACHE.get(mime_type) or mimetypes.guess_extension(mime_type)) if mime_type else None
+        file_extension = guessed_extension if guessed_extension else '.bin'
+
+    # 128 losowych bitów jako hex — ta sama odporność na kolizje co uuid4, bez budowania obiektu UUID i jego formatowania
+    unique_filename = f"{secrets.token_hex(16)}{file_extension}"
+    return unique_filename, os.path.join(UPLOAD_DIR, unique_filename)
+
+# Zapis na dysk jest blokujący, więc wykonujemy go w wątku (asyncio.to_thread) — pętla zdarzeń obsługuje w tym czasie inne uploady
+def _save_stream(src, file_path: str) -> None:
+    """Kopiuje zawartość obiektu plikowego na dysk porcjami po UPLOAD_CHUNK_SIZE."""
+    with open(file_path, "wb") as f:
+        shutil.copyfileobj(src, f, UPLOAD_CHUNK_SIZE)
+
+def _save_base64(file_path: str, encoded: str, start: int) -> None:
     """
-    Przyjmuje plik zakodowany w base64, zapisuje go i zwraca dostępny URL.
+    Dekoduje base64 z encoded[start:] porcjami po BASE64_CHUNK_CHARS znaków i od razu zapisuje je do pliku,
+    więc w pamięci nigdy nie ma całego zdekodowanego pliku. Przy błędzie dekodowania usuwa plik i rzuca ValueError.
     """
+    try:
+        with open(file_path, "wb") as f:
+            carry = ""
+            for pos in range(start, len(encoded), BASE64_CHUNK_CHARS):
+                # Białe znaki (np. zawijanie co 76 znaków) usuwamy w każdej porcji; resztę niepełnej czwórki
+                # przenosimy do następnej porcji, żeby dekodowane fragmenty zawsze były wyrównane do 4 znaków
+                piece = carry + _BASE64_JUNK_RE.sub('', encoded[pos:pos + BASE64_CHUNK_CHARS])
+                aligned = len(piece) - len(piece) % 4
+                if aligned:
+                    f.write(base64.b64decode(piece[:aligned]))
+                carry = piece[aligned:]
+            if carry:
+                # Brak paddingu na końcu danych — dopełniamy tylko ostatnią porcję
+                f.write(base64.b64decode(carry + "=" * (-len(carry) % 4)))
+    except ValueError:
+        os.remove(file_path)
+        raise
+
+async def _handle_multipart_upload(http_request: Request) -> dict:
+    """Format multipart/form-data (pola `file` i `api_key`): surowe bajty kopiowane porcjami na dysk, bez base64."""
+    async with http_request.form() as form:
+        if API_KEY and form.get("api_key") != API_KEY:
+            raise HTTPException(status_code=401, detail="Nieprawidłowy klucz API")
+
+        upload = form.get("file")
+        if not isinstance(upload, UploadFile):
+            raise HTTPException(status_code=400, detail="Brak pliku w polu 'file' żądania multipart.")
+
+        file_name = upload.filename or "file"
+        unique_filename, file_path = _build_unique_path(file_name, upload.content_type)
+        # Starlette zbuforował już plik w SpooledTemporaryFile — kopiujemy go jednym wywołaniem w wątku
+        await asyncio.to_thread(_save_stream, upload.file, file_path)
+
+    logger.info(f"Plik '{file_name}' został zapisany jako '{unique_filename}'.")
+    return {"success": True, "filename": unique_filename}
+
+async def _read_body(http_request: Request) -> bytearray:
+    """
+    Czyta ciało żądania do jednego bufora. W przeciwieństwie do Request.body()/json() Starlette
+    nie zatrzymuje kopii (bajtów ani sparsowanego dict) do końca obsługi żądania.
+    """
+    body = bytearray()
+    async for chunk in http_request.stream():
+        body += chunk
+    return body
+
+async def _handle_base64_upload(http_request: Request) -> dict:
+    """Format JSON z data URI base64 (UploadRequest) — wysyłany przez starsze wersje mostka."""
+    # Ciało czytamy strumieniowo (bez kopii trzymanych przez Request), a base64 dekodujemy porcjami prosto do pliku
+    try:
+        request = UploadRequest(**orjson.loads(await _read_body(http_request)))
+    except (ValueError, TypeError) as e:
+        raise HTTPException(status_code=422, detail=f"Nieprawidłowe ciało żądania: {e}")
+
     # Prosta weryfikacja klucza API
     if API_KEY and request.api_key != API_KEY:
         raise HTTPException(status_code=401, detail="Nieprawidłowy klucz API")
 
+    file_data = request.file_data
     try:
-        # 1. Rozdzielenie nagłówka i danych base64
-        header, encoded_data = request.file_data.split(',', 1)
-        
-        # 2. Dekodowanie base64
-        file_data = base64.b64decode(encoded_data)
-        
-        # 3. Generowanie unikalnej nazwy pliku, aby uniknąć konfliktów
-        file_extension = os.path.splitext(request.file_name)[1]
-        if not file_extension:
-            # Próba wywnioskowania rozszerzenia z typu MIME w nagłówku
-            import mimetypes
-            mime_type = header.split(';')[0].split(':')[1]
-            guessed_extension = mimetypes.guess_extension(mime_type)
-            file_extension = guessed_extension if guessed_extension else '.bin'
-
-        unique_filename = f"{uuid.uuid4()}{file_extension}"
-        file_path = os.path.join(UPLOAD_DIR, unique_filename)
-
-        # 4. Zapis pliku
-        with open(file_path, "wb") as f:
-            f.write(file_data)
+        # 1. Odszukanie separatora nagłówka — bez split, który tworzyłby listę z kopią nagłówka i danych
+        comma = file_data.find(',')
+        if comma < 0:
+            raise ValueError("brak separatora ',' w data URI")
+        header = file_data[:comma]
+
+        # 2. Generowanie unikalnej nazwy pliku, aby uniknąć konfliktów
+        mime_type = header.split(';')[0].split(':')[1]
+        unique_filename, file_path = _build_unique_path(request.file_name, mime_type)
+
+        # 3. Dekodowanie base64 porcjami wprost do pliku (w wątku)
+        await asyncio.to_thread(_save_base64, file_path, file_data, comma + 1)
         
-        # 5. Zwracamy sukces i nazwę pliku
+        # 4. Zwracamy sukces i nazwę pliku
         logger.info(f"Plik '{request.file_name}' został zapisany jako '{unique_filename}'.")
         
-        return JSONResponse(
-            status_code=200,
-            content={"success": True, "filename": unique_filename}
-        )
+        return {"success": True, "filename": unique_filename}
 
     except (ValueError, IndexError) as e:
         logger.error(f"Błąd parsowania base64: {e}")
         raise HTTPException(status_code=400, detail=f"Nieprawidłowy format base64 data URI: {e}")
+
+# --- Endpointy API ---
+@app.post("/upload")
+async def upload_file(http_request: Request):
+    """
+    Przyjmuje plik, zapisuje go i zwraca nazwę, pod którą jest dostępny w /uploads.
+    Obsługiwane formaty:
+      - multipart/form-data z polami `file` i `api_key` (zalecany — bez narzutu base64 i buforowania w JSON);
+      - JSON {file_name, file_data (base64 data URI), api_key} — dla zgodności ze starszymi wersjami mostka.
+    """
+    try:
+        if http_request.headers.get("content-type", "").startswith(("multipart/form-data", "application/x-www-form-urlencoded")):
+            return await _handle_multipart_upload(http_request)
+        return await _handle_base64_upload(http_request)
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Nieznany błąd podczas obsługi uploadu: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"Błąd wewnętrzny serwera: {e}")
@@ -145,4 +287,19 @@ if __name__ == "__main__":
     logger.info("   - Adres nasłuchu: http://127.0.0.1:5180")
     logger.info(f"   - Endpoint upload: http://127.0.0.1:5180/upload")
     logger.info(f"   - Ścieżka do plików: /uploads")
-    uvicorn.run(app, host="0.0.0.0", port=5180)
\ No newline at end of file
+
+    # uvloop (pętla oparta o libuv) i httptools (parser HTTP w C) znacznie przyspieszają przyjmowanie dużych ciał żądań.
+    # uvloop nie jest dostępny na Windows — wtedy zostajemy przy asyncio / h11.
+    try:
+        import uvloop  # noqa: F401
+        loop_impl = "uvloop"
+    except ImportError:
+        loop_impl = "asyncio"
+    try:
+        import httptools  # noqa: F401
+        http_impl = "httptools"
+    except ImportError:
+        http_impl = "h11"
+    logger.info(f"   - Pętla zdarzeń: {loop_impl}, parser HTTP: {http_impl}")
+
+    uvicorn.run(app, host="0.0.0.0", port=5180, loop=loop_impl, http=http_impl)
\ No newline at end of file
@@ -3,19 +3,28 @@
 # To jednorazowy, zaktualizowany serwer HTTP, który na podstawie wybranego przez użytkownika trybu
 # (DirectChat lub Battle) odbiera informacje o sesji z skryptu Tampermonkey i aktualizuje plik config.jsonc.
 
+import functools
 import http.server
-import socketserver
-import json
 import re
 import threading
 import os
+import orjson
 import requests
 
+# pyjson5 (rozszerzenie w C) parsuje JSONC natywnie w jednym przebiegu; bez niego usuwamy komentarze regexem i parsujemy orjson
+try:
+    import pyjson5
+except ImportError:
+    pyjson5 = None
+
 # --- Konfiguracja ---
 HOST = "127.0.0.1"
 PORT = 5103
 CONFIG_PATH = 'config.jsonc'
 
+# Komentarz liniowy, blokowy albo cały łańcuch JSON (dopasowany po to, by nie ruszać "//" i "/*" wewnątrz wartości)
+_JSONC_RE = re.compile(r'//[^\n]*|/\*.*?\*/|"(?:\\.|[^"\\])*"', re.DOTALL)
+
 def read_config():
     """Wczytuje i parsuje plik config.jsonc, usuwając komentarze przed parsowaniem."""
     if not os.path.exists(CONFIG_PATH):
@@ -23,40 +32,23 @@ def read_config():
         return None
     try:
         with open(CONFIG_PATH, 'r', encoding='utf-8') as f:
-            lines = f.readlines()
-        
-        # Bardziej odporne usuwanie komentarzy — przetwarzamy linię po linii, aby nie usuwać "//" w URL-ach
-        no_comments_lines = []
-        in_block_comment = False
-        for line in lines:
-            stripped_line = line.strip()
-            if in_block_comment:
-                if '*/' in stripped_line:
-                    in_block_comment = False
-                    line = stripped_line.split('*/', 1)[1]
-                else:
-                    continue
-            
-            if '/*' in line and not in_block_comment:
-                before_comment, _, after_comment = line.partition('/*')
-                if '*/' in after_comment:
-                    _, _, after_block = after_comment.partition('*/')
-                    line = before_comment + after_block
-                else:
-                    line = before_comment
-                    in_block_comment = True
+            content = f.read()
 
-            if line.strip().startswith('//'):
-                continue
-            
-            no_comments_lines.append(line)
+        if pyjson5 is not None:
+            return pyjson5.loads(content)
 
-        json_content = "".join(no_comments_lines)
-        return json.loads(json_content)
+        # Komentarze usuwamy jednym przebiegiem regex; łańcuchy w cudzysłowie zostają nietknięte (np. "//" w URL-ach)
+        json_content = _JSONC_RE.sub(lambda m: m.group(0) if m.group(0).startswith('"') else '', content)
+        return orjson.loads(json_content)
     except Exception as e:
         print(f"❌ Błąd podczas odczytu lub parsowania '{CONFIG_PATH}': {e}")
         return None
 
+@functools.lru_cache(maxsize=64)
+def _compile_key_pattern(key):
+    """Kompiluje (raz na klucz) wzorzec dopasowujący wartość typu string danego klucza w config.jsonc."""
+    return re.compile(rf'("{re.escape(key)}"\s*:\s*")[^"]*(")')
+
 def save_config_value(key, value):
     """
     Bezpiecznie aktualizuje pojedynczą parę klucz-wartość w config.jsonc, zachowując oryginalne formatowanie i komentarze.
@@ -68,8 +60,9 @@ def save_config_value(key, value):
 
         # Używamy wyrażenia regularnego do bezpiecznej zamiany wartości
         # Znajdzie "key": "dowolna_wartość" i zastąpi dowolna_wartość nową wartością
-        pattern = re.compile(rf'("{key}"\s*:\s*")[^"]*(")')
-        new_content, count = pattern.subn(rf'\g<1>{value}\g<2>', content, 1)
+        pattern = _compile_key_pattern(key)
+        # Funkcja zwrotna wstawia wartość dosłownie (ukośniki w wartości nie są traktowane jako odwołania do grup)
+        new_content, count = pattern.subn(lambda m: m.group(1) + str(value) + m.group(2), content, 1)
 
         if count == 0:
             print(f"🤔 Ostrzeżenie: Nie znaleziono klucza '{key}' w pliku '{CONFIG_PATH}'.")
@@ -95,22 +88,40 @@ def save_session_ids(session_id, message_id):
         print(f"❌ Aktualizacja ID nie powiodła się. Sprawdź powyższe komunikaty o błędach.")
 
 class RequestHandler(http.server.SimpleHTTPRequestHandler):
+    # HTTP/1.1 utrzymuje połączenie między preflightem OPTIONS a właściwym POST; każda odpowiedź musi więc mieć Content-Length
+    protocol_version = 'HTTP/1.1'
+    # TCP_NODELAY — krótkie odpowiedzi nie czekają na algorytm Nagle'a
+    disable_nagle_algorithm = True
+
     def _send_cors_headers(self):
         self.send_header('Access-Control-Allow-Origin', '*')
         self.send_header('Access-Control-Allow-Methods', 'POST, OPTIONS')
         self.send_header('Access-Control-Allow-Headers', 'Content-Type')
 
-    def do_OPTIONS(self):
-        self.send_response(204)
+    def _send_body(self, code, body=b'', message=None, close=False):
+        """Wysyła odpowiedź z nagłówkami CORS i Content-Length; `close` zamyka połączenie po odpowiedzi."""
+        self.send_response(code, message)
         self._send_cors_headers()
+        if body:
+            self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if close:
+            self.send_header('Connection', 'close')
         self.end_headers()
+        if body:
+            self.wfile.write(body)
+
+    def do_OPTIONS(self):
+        # Preflight nie ma ciała; gdyby jednak je zadeklarował, zamykamy połączenie zamiast je odczytywać
+        has_body = self.headers.get('Content-Length', '0') != '0' or 'Transfer-Encoding' in self.headers
+        self._send_body(204, close=has_body)
 
     def do_POST(self):
         if self.path == '/update':
             try:
                 content_length = int(self.headers['Content-Length'])
                 post_data = self.rfile.read(content_length)
-                data = json.loads(post_data)
+                data = orjson.loads(post_data)
 
                 session_id = data.get('sessionId')
                 message_id = data.get('messageId')
@@ -124,35 +135,28 @@ class RequestHandler(http.server.SimpleHTTPRequestHandler):
 
                     save_session_ids(session_id, message_id)
 
-                    self.send_response(200)
-                    self._send_cors_headers()
-                    self.end_headers()
-                    self.wfile.write(b'{"status": "success"}')
+                    # To ostatnia odpowiedź przed zamknięciem serwera — nie utrzymujemy już połączenia
+                    self._send_body(200, b'{"status": "success"}', close=True)
 
                     print("\nZadanie zakończone. Serwer zamknie się automatycznie za 1 sekundę.")
                     threading.Thread(target=self.server.shutdown).start()
 
                 else:
-                    self.send_response(400, "Bad Request")
-                    self._send_cors_headers()
-                    self.end_headers()
-                    self.wfile.write(b'{"error": "Brak sessionId lub messageId"}')
+                    self._send_body(400, b'{"error": "Brak sessionId lub messageId"}', "Bad Request")
             except Exception as e:
-                self.send_response(500, "Internal Server Error")
-                self._send_cors_headers()
-                self.end_headers()
-                self.wfile.write(f'{{"error": "Błąd wewnętrzny serwera: {e}"}}'.encode('utf-8'))
+                self._send_body(500, orjson.dumps({"error": f"Błąd wewnętrzny serwera: {e}"}), "Internal Server Error", close=True)
         else:
-            self.send_response(404, "Not Found")
-            self._send_cors_headers()
-            self.end_headers()
+            # Ciała żądania nie czytamy, więc zamykamy połączenie — inaczej jego treść zostałaby odczytana jako kolejne żądanie
+            self._send_body(404, message="Not Found", close=True)
 
     def log_message(self, format, *args):
         # Wyłączamy domyślne logowanie HTTP, żeby konsola była czytelniejsza
         return
 
 def run_server():
-    with socketserver.TCPServer((HOST, PORT), RequestHandler) as httpd:
+    # Serwer wielowątkowy: preflight OPTIONS i ponowienia z przeglądarki nie blokują się nawzajem.
+    # ThreadingHTTPServer ma domyślnie daemon_threads = True, więc wątki połączeń keep-alive nie wstrzymują zamknięcia.
+    with http.server.ThreadingHTTPServer((HOST, PORT), RequestHandler) as httpd:
         print("\n" + "="*50)
         print("  🚀 Nasłuchiwacz aktualizacji Session ID uruchomiony")
         print(f"  - Adres nasłuchu: http://{HOST}:{PORT}")
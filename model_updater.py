@@ -1,4 +1,5 @@
 # model_updater.py
+import orjson
 import requests
 import time
 import logging
@@ -16,12 +17,13 @@ def trigger_model_update():
         response = requests.post(f"{API_SERVER_URL}/internal/request_model_update")
         response.raise_for_status()
         
-        if response.json().get("status") == "success":
+        result = orjson.loads(response.content)
+        if result.get("status") == "success":
             logging.info("✅ Pomyślnie wysłano żądanie aktualizacji listy modeli.")
             logging.info("Upewnij się, że strona LMArena jest otwarta — skrypt automatycznie pobierze najnowszą listę modeli.")
             logging.info("Serwer zapisze wynik do pliku `available_models.json`.")
         else:
-            logging.error(f"❌ Serwer zwrócił błąd: {response.json().get('message')}")
+            logging.error(f"❌ Serwer zwrócił błąd: {result.get('message')}")
 
     except requests.exceptions.RequestException as e:
         logging.error(f"❌ Nie można połączyć się z serwerem głównym ({API_SERVER_URL}).")
@@ -1,4 +1,6 @@
 # modules/file_uploader.py
+import asyncio
+import base64
 import httpx
 import logging
 
@@ -8,9 +10,49 @@ from typing import Tuple
 
 from typing import Tuple
 
+# Współdzielony klient HTTP — kolejne uploady korzystają z puli połączeń keep-alive zamiast zestawiać nowe połączenie za każdym razem
+_CLIENT: httpx.AsyncClient | None = None
+
+def _get_client() -> httpx.AsyncClient:
+    """Zwraca współdzielonego klienta httpx, tworząc go przy pierwszym użyciu."""
+    global _CLIENT
+    if _CLIENT is None or _CLIENT.is_closed:
+        _CLIENT = httpx.AsyncClient(
+            timeout=60.0,
+            limits=httpx.Limits(max_keepalive_connections=20, max_connections=100),
+        )
+    return _CLIENT
+
+async def close_client():
+    """Zamyka współdzielonego klienta (wywoływane przy zamykaniu serwera)."""
+    global _CLIENT
+    if _CLIENT is not None:
+        await _CLIENT.aclose()
+        _CLIENT = None
+
+# Zapamiętany wynik rozpoznania serwera file bed: upload_url -> czy przyjmuje multipart (False = starszy serwer, tylko JSON)
+_MULTIPART_SUPPORT: dict[str, bool] = {}
+
+async def _supports_multipart(client: httpx.AsyncClient, upload_url: str, api_key: str | None) -> bool:
+    """
+    Sprawdza (raz na upload_url), czy serwer file bed przyjmuje multipart. Wysyła mały formularz bez pliku:
+    starszy serwer, oczekujący JSON, odpowiada na niego błędem walidacji 422, a nowy — 400/401 z obsługi formularza.
+    Pliku binarnego nie wysyłamy na ślepo, bo starszy serwer odpowiada na niego 500 i zrywa połączenie.
+    """
+    supported = _MULTIPART_SUPPORT.get(upload_url)
+    if supported is None:
+        response = await client.post(upload_url, data={"api_key": api_key or ""})
+        supported = response.status_code != 422
+        _MULTIPART_SUPPORT[upload_url] = supported
+        if not supported:
+            logger.info(f"Serwer file bed {upload_url} nie obsługuje multipart — pliki będą wysyłane w formacie JSON (base64).")
+    return supported
+
 async def upload_to_file_bed(file_name: str, file_data: str, upload_url: str, api_key: str | None = None) -> Tuple[str | None, str | None]:
     """
-    Wysyła plik zakodowany w base64 do serwera file bed.
+    Wysyła plik do serwera file bed jako multipart/form-data (surowe bajty zamiast base64 w JSON).
+    Starszy serwer, który nie obsługuje multipart (rozpoznany po odpowiedzi 422), dostaje plik w dawnym formacie JSON;
+    wynik rozpoznania jest zapamiętywany dla danego upload_url.
 
     :param file_name: Oryginalna nazwa pliku.
     :param file_data: Base64 data URI (np. "data:image/png;base64,...").
@@ -19,27 +61,52 @@ async def upload_to_file_bed(file_name: str, file_data: str, upload_url: str, ap
     :return: Krotka (filename, error_message). Przy sukcesie filename to nazwa pliku, error_message jest None;
              przy niepowodzeniu filename jest None, a error_message zawiera opis błędu.
     """
-    payload = {
-        "file_name": file_name,
-        "file_data": file_data,
-        "api_key": api_key
-    }
-    
     try:
-        async with httpx.AsyncClient(timeout=60.0) as client:
+        client = _get_client()
+        use_multipart = await _supports_multipart(client, upload_url, api_key)
+
+        if use_multipart:
+            try:
+                # Dekodujemy data URI po stronie mostka — na łączu idą surowe bajty (o ~33% mniej niż base64).
+                # Dekodowanie wielomegabajtowych załączników idzie w wątku, żeby nie blokować pętli zdarzeń.
+                header, encoded_data = file_data.split(',', 1)
+                mime_type = header.split(';')[0].split(':', 1)[1] or "application/octet-stream"
+                raw_bytes = await asyncio.to_thread(base64.b64decode, encoded_data)
+            except (ValueError, IndexError) as e:
+                error_details = f"Nieprawidłowy format base64 data URI: {e}"
+                logger.error(f"Nie można przygotować pliku '{file_name}' do wysłania: {error_details}")
+                return None, error_details
+
+            response = await client.post(
+                upload_url,
+                files={"file": (file_name, raw_bytes, mime_type)},
+                data={"api_key": api_key} if api_key else None,
+            )
+            if response.status_code == 422:
+                # Serwer pod tym adresem został zastąpiony starszą wersją — zapamiętujemy to i ponawiamy w formacie JSON
+                _MULTIPART_SUPPORT[upload_url] = False
+                use_multipart = False
+                logger.info("Serwer file bed nie obsługuje multipart — ponawiam wysyłkę w formacie JSON (base64).")
+
+        if not use_multipart:
+            payload = {
+                "file_name": file_name,
+                "file_data": file_data,
+                "api_key": api_key
+            }
             response = await client.post(upload_url, json=payload)
+
+        response.raise_for_status()  # jeśli status 4xx/5xx, rzuć wyjątek
+        
+        result = response.json()
+        if result.get("success") and result.get("filename"):
+            logger.info(f"Plik '{file_name}' został pomyślnie przesłany do file bed, nazwa pliku: {result['filename']}")
+            return result["filename"], None
+        else:
+            error_msg = result.get("error", "Serwer file bed zwrócił nieznany błąd.")
+            logger.error(f"Przesyłanie do file bed nie powiodło się: {error_msg}")
+            return None, error_msg
             
-            response.raise_for_status()  # jeśli status 4xx/5xx, rzuć wyjątek
-            
-            result = response.json()
-            if result.get("success") and result.get("filename"):
-                logger.info(f"Plik '{file_name}' został pomyślnie przesłany do file bed, nazwa pliku: {result['filename']}")
-                return result["filename"], None
-            else:
-                error_msg = result.get("error", "Serwer file bed zwrócił nieznany błąd.")
-                logger.error(f"Przesyłanie do file bed nie powiodło się: {error_msg}")
-                return None, error_msg
-                
     except httpx.HTTPStatusError as e:
         error_details = f"Błąd HTTP: {e.response.status_code} - {e.response.text}"
         logger.error(f"Wystąpił błąd podczas przesyłania do file bed: {error_details}")
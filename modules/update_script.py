@@ -6,38 +6,27 @@ import subprocess
 import sys
 import json
 import re
+import orjson
+from concurrent.futures import ThreadPoolExecutor
+
+# pyjson5 (rozszerzenie w C) parsuje JSONC natywnie w jednym przebiegu; bez niego usuwamy komentarze regexem i parsujemy orjson
+try:
+    import pyjson5
+except ImportError:
+    pyjson5 = None
+
+# Komentarze JSONC usuwamy jednym przebiegiem wyrażenia regularnego (w C) zamiast pętli po liniach.
+# Alternatywa z łańcuchem w cudzysłowie chroni "//" i "/*" wewnątrz wartości (np. URL-e).
+_JSONC_RE = re.compile(r'//[^\n]*|/\*.*?\*/|"(?:\\.|[^"\\])*"', re.DOTALL)
 
 def _parse_jsonc(jsonc_string: str) -> dict:
     """
     Solidne parsowanie ciągu JSONC — usuwa komentarze.
     """
-    lines = jsonc_string.splitlines()
-    no_comments_lines = []
-    in_block_comment = False
-    for line in lines:
-        stripped_line = line.strip()
-        if in_block_comment:
-            if '*/' in stripped_line:
-                in_block_comment = False
-                line = stripped_line.split('*/', 1)[1]
-            else:
-                continue
-        
-        if '/*' in line and not in_block_comment:
-            before_comment, _, after_comment = line.partition('/*')
-            if '*/' in after_comment:
-                _, _, after_block = after_comment.partition('*/')
-                line = before_comment + after_block
-            else:
-                line = before_comment
-                in_block_comment = True
-
-        if line.strip().startswith('//'):
-            continue
-        
-        no_comments_lines.append(line)
-
-    return json.loads("\n".join(no_comments_lines))
+    if pyjson5 is not None:
+        return pyjson5.loads(jsonc_string)
+    cleaned = _JSONC_RE.sub(lambda m: m.group(0) if m.group(0).startswith('"') else '', jsonc_string)
+    return orjson.loads(cleaned)
 
 def load_jsonc_values(path):
     """Wczytuje wartości z pliku .jsonc, ignorując komentarze — zwraca słownik klucz-wartość."""
@@ -49,19 +38,75 @@ def load_jsonc_values(path):
         print(f"Błąd podczas ładowania lub parsowania {path}: {e}")
         return None
 
+def merge_config_values(config_content: str, values: dict) -> str:
+    """
+    Wstawia wartości `values` do treści config.jsonc, zachowując komentarze i formatowanie.
+    Wszystkie klucze dopasowujemy jednym wzorcem (alternatywa kluczy) i jednym przebiegiem sub z funkcją zwrotną,
+    zamiast kompilować i uruchamiać osobny regex dla każdego klucza.
+    """
+    if not values:
+        return config_content
+    # orjson.dumps daje poprawny literał JSON (cudzysłowy, ukośniki, true/false); zastępstwo z funkcji jest wstawiane dosłownie
+    replacements = {key: orjson.dumps(value).decode() for key, value in values.items()}
+    pattern = re.compile(
+        r'("(' + '|'.join(map(re.escape, replacements)) + r')"\s*:\s*)(?:".*?"|true|false|[\d\.]+)'
+    )
+    return pattern.sub(lambda m: m.group(1) + replacements[m.group(2)], config_content)
+
+def _link_or_copy(src, dst):
+    """
+    Umieszcza plik src pod ścieżką dst. Na tym samym systemie plików tworzy twarde dowiązanie
+    (bez kopiowania bajtów) pod nazwą tymczasową i atomowo podmienia nim dst; w przeciwnym razie kopiuje (copy2).
+    """
+    tmp_path = dst + ".update_tmp"
+    try:
+        if os.path.lexists(tmp_path):
+            os.remove(tmp_path)
+        os.link(src, tmp_path)
+        os.replace(tmp_path, dst)
+    except OSError:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        shutil.copy2(src, dst)
+
+def copy_items(pairs):
+    """
+    Kopiuje listę par (źródło, cel) — pliki i katalogi. Katalogi przechodzimy jednym os.walk,
+    tworząc strukturę od razu, a same pliki przenosimy równolegle w puli wątków.
+    """
+    file_pairs = []
+    for src, dst in pairs:
+        if not os.path.isdir(src):
+            file_pairs.append((src, dst))
+            continue
+        for root, dirs, files in os.walk(src):
+            target_root = os.path.join(dst, os.path.relpath(root, src))
+            os.makedirs(target_root, exist_ok=True)
+            for name in files:
+                file_pairs.append((os.path.join(root, name), os.path.join(target_root, name)))
+
+    with ThreadPoolExecutor(max_workers=min(8, (os.cpu_count() or 1) + 4)) as executor:
+        # Iteracja po wynikach przekazuje dalej ewentualny wyjątek z któregokolwiek wątku
+        for _ in executor.map(lambda pair: _link_or_copy(*pair), file_pairs):
+            pass
+    return len(file_pairs)
+
 def get_all_relative_paths(directory):
     """Zwraca zbiór względnych ścieżek wszystkich plików i pustych katalogów w danym katalogu."""
     paths = set()
-    for root, dirs, files in os.walk(directory):
+    # Ścieżki z os.walk zaczynają się dokładnie od `directory` — ścieżkę względną dostajemy przez wycięcie prefiksu zamiast os.path.relpath
+    prefix_len = len(os.path.join(directory, ''))
+    # Przejście od dołu (topdown=False): katalog jest pusty, gdy na jego poziomie nie ma ani plików, ani podkatalogów — bez dodatkowego os.listdir
+    for root, dirs, files in os.walk(directory, topdown=False):
+        rel_root = root[prefix_len:]
         # Dodaj pliki
         for name in files:
-            path = os.path.join(root, name)
-            paths.add(os.path.relpath(path, directory))
-        # Dodaj puste katalogi
-        for name in dirs:
-            dir_path = os.path.join(root, name)
-            if not os.listdir(dir_path):
-                paths.add(os.path.relpath(dir_path, directory) + os.sep)
+            paths.add(os.path.join(rel_root, name))
+        # Dodaj puste katalogi (sam katalog główny pomijamy)
+        if not files and not dirs and rel_root:
+            paths.add(rel_root + os.sep)
     return paths
 
 def main():
@@ -110,6 +155,7 @@ def main():
     print("\n[+] Kopiowanie nowych plików...")
     try:
         new_config_template_path = os.path.join(source_dir_inner, config_filename)
+        items_to_copy = []
         
         for item in os.listdir(source_dir_inner):
             s = os.path.join(source_dir_inner, item)
@@ -128,11 +174,10 @@ def main():
             if os.path.basename(s) == models_filename:
                 continue # Pomijamy models.json — zachowujemy lokalną wersję użytkownika
 
-            if os.path.isdir(s):
-                shutil.copytree(s, d, dirs_exist_ok=True)
-            else:
-                shutil.copy2(s, d)
-        print("Kopiowanie plików zakończone pomyślnie.")
+            items_to_copy.append((s, d))
+
+        copied_count = copy_items(items_to_copy)
+        print(f"Kopiowanie plików zakończone pomyślnie ({copied_count} plików).")
 
     except Exception as e:
         print(f"Wystąpił błąd podczas kopiowania plików: {e}")
@@ -149,17 +194,7 @@ def main():
             new_version = new_version_values.get("version", "unknown")
             old_config_values["version"] = new_version
 
-            for key, value in old_config_values.items():
-                if isinstance(value, str):
-                    replacement_value = f'"{value}"'
-                elif isinstance(value, bool):
-                    replacement_value = str(value).lower()
-                else:
-                    replacement_value = str(value)
-                
-                pattern = re.compile(f'("{key}"\s*:\s*)(?:".*?"|true|false|[\d\.]+)')
-                if pattern.search(new_config_content):
-                    new_config_content = pattern.sub(f'\\g<1>{replacement_value}', new_config_content)
+            new_config_content = merge_config_values(new_config_content, old_config_values)
 
             with open(old_config_path, 'w', encoding='utf-8') as f:
                 f.write(new_config_content)